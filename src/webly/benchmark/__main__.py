@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import argparse
+import json
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+from unittest import mock
+
+from loguru import logger
+
+from webly import scraper
+from webly.downloader import download_image
+from webly.expander import Expander
+from webly.tracing import percentile
+
+from .corpora import synthetic_predicates, write_ngrams
+from .fake_driver import RECORDINGS, FakeDriver
+from .fixtures import DEFAULT_SIZES, FixtureServer, image_bytes
+
+ENGINES = {
+    "google": scraper.get_google_images,
+    "yahoo": scraper.get_yahoo_images,
+    "flickr": scraper.get_flickr_images,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmarks")
+    parser.add_argument(
+        "--scenarios",
+        choices=[*ENGINES, "download", "expander"],
+        nargs="+",
+        default=[*ENGINES, "download", "expander"],
+    )
+    parser.add_argument(
+        "--output-json",
+        type=Path,
+        help="append one json line per scenario to this file, to compare versions",
+        default=None,
+    )
+
+    engines = parser.add_argument_group("Engine options")
+    engines.add_argument("--queries", type=int, help="queries per engine", default=2)
+    engines.add_argument(
+        "--num-images", type=int, help="max number of images per query", default=20
+    )
+    engines.add_argument(
+        "--results", type=int, help="results available per query", default=100
+    )
+    engines.add_argument(
+        "--latency", type=float, help="seconds per WebDriver command", default=0.002
+    )
+    engines.add_argument(
+        "--page-load", type=float, help="seconds per page load", default=0.2
+    )
+    engines.add_argument(
+        "--sleep-scale",
+        type=float,
+        help="multiply the scraper's hardcoded sleeps, e.g. 0 to measure command overhead only",
+        default=1.0,
+    )
+
+    download = parser.add_argument_group("Download options")
+    download.add_argument(
+        "--downloads", type=int, help="downloads per fixture size", default=10
+    )
+    download.add_argument(
+        "--server-latency", type=float, help="seconds per http response", default=0.0
+    )
+
+    expander = parser.add_argument_group("Expander options")
+    expander.add_argument("--predicates", type=int, default=70)
+    expander.add_argument("--ngrams", type=int, nargs="+", default=[2, 3, 4, 5])
+    expander.add_argument("--ngrams-per-file", type=int, default=10)
+
+    return parser.parse_args()
+
+
+@contextmanager
+def scaled_sleep(scale: float):
+    sleep = time.sleep
+    with mock.patch("time.sleep", lambda seconds: sleep(seconds * scale)):
+        yield
+
+
+def report(scenario: str, items: int, seconds: float, latencies: List[float], **extra):
+    latencies = sorted(latencies)
+    return {
+        "scenario": scenario,
+        "items": items,
+        "seconds": seconds,
+        "items/s": items / seconds if seconds > 0 else float("nan"),
+        "p50_ms": 1000 * percentile(latencies, 50),
+        "p90_ms": 1000 * percentile(latencies, 90),
+        "p99_ms": 1000 * percentile(latencies, 99),
+        **extra,
+    }
+
+
+def bench_engine(engine: str, args) -> Dict:
+    """Time between consecutive results, including page load and scrolling"""
+    latencies = []
+    commands = 0
+    scrolls = 0
+    start = time.perf_counter()
+    with scaled_sleep(args.sleep_scale):
+        for q in range(args.queries):
+            driver = FakeDriver(
+                RECORDINGS[engine](total=args.results),
+                latency=args.latency,
+                page_load=args.page_load,
+            )
+            with driver:
+                last = time.perf_counter()
+                budget = scraper.ScrollBudget(args.num_images)
+                for _ in ENGINES[engine](driver, f"query {q}", budget):
+                    now = time.perf_counter()
+                    latencies.append(now - last)
+                    last = now
+            commands += driver.commands
+            scrolls += budget.scrolls
+    seconds = time.perf_counter() - start
+    return report(
+        engine,
+        len(latencies),
+        seconds,
+        latencies,
+        commands_per_item=commands / max(1, len(latencies)),
+        scrolls_per_query=scrolls / max(1, args.queries),
+    )
+
+
+def bench_download(args) -> Dict:
+    latencies = []
+    total_bytes = 0
+    with FixtureServer(latency=args.server_latency) as server, tempfile.TemporaryDirectory() as tmp:
+        urls = server.image_urls() * args.downloads
+        sizes = DEFAULT_SIZES * args.downloads
+        start = time.perf_counter()
+        for i, (url, (w, h)) in enumerate(zip(urls, sizes)):
+            t0 = time.perf_counter()
+            download_image({"url": url}, Path(tmp) / f"{i}.jpg")
+            latencies.append(time.perf_counter() - t0)
+            total_bytes += len(image_bytes(w, h))
+        seconds = time.perf_counter() - start
+    return report(
+        "download",
+        len(latencies),
+        seconds,
+        latencies,
+        MB_per_s=total_bytes / 2 ** 20 / seconds,
+    )
+
+
+def bench_expander(args) -> Dict:
+    """Time to expand each predicate, items are expanded queries"""
+    latencies = []
+    items = 0
+    predicates = synthetic_predicates(args.predicates)
+    with tempfile.TemporaryDirectory() as tmp:
+        write_ngrams(tmp, predicates, args.ngrams, args.ngrams_per_file)
+        expander = Expander(ngrams_dir=tmp, ngrams=args.ngrams)
+        start = time.perf_counter()
+        for p in predicates:
+            t0 = time.perf_counter()
+            items += sum(1 for _ in expander.expand(p))
+            latencies.append(time.perf_counter() - t0)
+        seconds = time.perf_counter() - start
+    return report("expander", items, seconds, latencies)
+
+
+def webly_version() -> str:
+    from importlib.metadata import PackageNotFoundError, version
+
+    try:
+        return version("webly")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def main():
+    import tabulate
+
+    args = parse_args()
+    logger.remove()
+
+    rows = []
+    for scenario in args.scenarios:
+        if scenario in ENGINES:
+            rows.append(bench_engine(scenario, args))
+        elif scenario == "download":
+            rows.append(bench_download(args))
+        elif scenario == "expander":
+            rows.append(bench_expander(args))
+    print(tabulate.tabulate(rows, headers="keys", floatfmt=".2f"))
+
+    if args.output_json is not None:
+        meta = {"version": webly_version(), "datetime_utc": str(datetime.utcnow())}
+        with args.output_json.open("a") as f:
+            for row in rows:
+                f.write(json.dumps({**meta, **row}) + "\n")
+
+
+"""
+python -m webly.benchmark --sleep-scale 0 --output-json bench.jsonl
+python -m webly.benchmark --scenarios google --queries 5 --latency 0.01
+"""
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import random
+from pathlib import Path
+from typing import List, Sequence, Union
+
+WORDS = (
+    "the a man woman dog cat car street table chair cup horse bike tree "
+    "person boy girl sky road grass water house window shirt hat bag"
+).split()
+
+
+def synthetic_predicates(num: int, seed: int = 0) -> List[str]:
+    """Unique one to three word predicates, in the spirit of data/vrd/predicates.txt"""
+    rng = random.Random(seed)
+    verbs = "on wear has next to sleep sit stand ride hold carry behind above under".split()
+    predicates = []
+    seen = set()
+    while len(predicates) < num:
+        p = " ".join(rng.sample(verbs, rng.randint(1, 3)))
+        if p not in seen:
+            seen.add(p)
+            predicates.append(p)
+    return predicates
+
+
+def write_predicates(path: Union[str, Path], predicates: Sequence[str]) -> Path:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("".join(f"{p}\n" for p in predicates))
+    return path
+
+
+def write_ngrams(
+    ngrams_dir: Union[str, Path],
+    predicates: Sequence[str],
+    ngrams: Sequence[int] = (2, 3, 4, 5),
+    per_file: int = 10,
+    seed: int = 0,
+) -> Path:
+    """Write `<n>gram/<predicate>.txt` files in the format of data/ngrams/processed"""
+    rng = random.Random(seed)
+    ngrams_dir = Path(ngrams_dir)
+    for n in ngrams:
+        (ngrams_dir / f"{n}gram").mkdir(parents=True, exist_ok=True)
+        for p in predicates:
+            lines = []
+            count = 10 ** 5
+            for _ in range(per_file):
+                count = rng.randint(count // 2, count)
+                words = [rng.choice(WORDS) for _ in range(max(0, n - len(p.split())))]
+                pos = rng.randint(0, len(words))
+                lines.append(f"{count} {' '.join(words[:pos] + [p] + words[pos:])}\n")
+            path = ngrams_dir / f"{n}gram" / f'{p.replace(" ", "_")}.txt'
+            path.write_text("".join(lines))
+    return ngrams_dir
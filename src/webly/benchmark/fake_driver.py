@@ -0,0 +1,245 @@
+from __future__ import annotations
+
+import json
+import random
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Sequence, Union
+
+from selenium.common.exceptions import NoSuchElementException
+
+# Captured at import so that scaling the scraper's sleeps does not affect the simulated latency
+_sleep = time.sleep
+
+_BY = {
+    "class_name": "class name",
+    "css_selector": "css selector",
+    "id": "id",
+    "link_text": "link text",
+    "name": "name",
+    "partial_link_text": "partial link text",
+    "tag_name": "tag name",
+    "xpath": "xpath",
+}
+
+# A recording is a json document like:
+# {
+#     "states": [
+#         {"<by>:<value>": [<element>, ...], ...},  # DOM before any scrolling
+#         {"<by>:<value>": [<element>, ...], ...},  # DOM after the first scroll
+#         ...
+#     ]
+# }
+# where <element> is {"text": str, "attributes": {...}, "children": {...}, "on_click": {...}}.
+# `children` maps locators to elements nested under this element, `on_click` maps locators to
+# elements that become visible on the page after the element is clicked (e.g. a preview pane).
+
+
+class _Finder(object):
+    def _lookup(self, locator: str) -> List[FakeElement]:
+        raise NotImplementedError
+
+    def find_elements(self, by="id", value=None) -> List[FakeElement]:
+        self._driver._command()
+        return list(self._lookup(f"{by}:{value}"))
+
+    def find_element(self, by="id", value=None) -> FakeElement:
+        elements = self.find_elements(by, value)
+        if len(elements) == 0:
+            raise NoSuchElementException(f"No element for {by}={value}")
+        return elements[0]
+
+    def __getattr__(self, name):
+        if name.startswith("find_elements_by_") and name[17:] in _BY:
+            return lambda value: self.find_elements(_BY[name[17:]], value)
+        if name.startswith("find_element_by_") and name[16:] in _BY:
+            return lambda value: self.find_element(_BY[name[16:]], value)
+        raise AttributeError(name)
+
+
+class FakeElement(_Finder):
+    def __init__(self, driver: FakeDriver, spec: Mapping[str, Any]):
+        self._driver = driver
+        self._text = spec.get("text", "")
+        self._attributes = dict(spec.get("attributes", {}))
+        self._children = {
+            loc: [FakeElement(driver, s) for s in specs]
+            for loc, specs in spec.get("children", {}).items()
+        }
+        self._on_click = {
+            loc: [FakeElement(driver, s) for s in specs]
+            for loc, specs in spec.get("on_click", {}).items()
+        }
+
+    def _lookup(self, locator):
+        return self._children.get(locator, [])
+
+    @property
+    def text(self) -> str:
+        self._driver._command()
+        return self._text
+
+    def get_attribute(self, name):
+        self._driver._command()
+        return self._attributes.get(name)
+
+    def click(self):
+        self._driver._command()
+        self._driver._overlay.update(self._on_click)
+
+
+class FakeDriver(_Finder):
+    """Scriptable stand-in for a WebDriver that replays recorded DOM states
+
+    Every scroll to the end of the page advances to the next recorded state, clicking an
+    element reveals its `on_click` elements. Each command sleeps for `latency` seconds
+    (plus up to `jitter` seconds), each `get` for `page_load` seconds.
+    """
+
+    def __init__(
+        self,
+        states: Sequence[Mapping[str, List[Mapping]]],
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        page_load: float = 0.0,
+    ):
+        self._driver = self
+        self._states = [
+            {loc: [FakeElement(self, s) for s in specs] for loc, specs in state.items()}
+            for state in states
+        ]
+        self._state_idx = 0
+        self._overlay = {}
+        self.latency = latency
+        self.jitter = jitter
+        self.page_load = page_load
+        self.commands = 0
+        self.current_url = None
+
+    @classmethod
+    def from_file(cls, path: Union[str, Path], **kwargs) -> FakeDriver:
+        return cls(json.loads(Path(path).read_text())["states"], **kwargs)
+
+    def _command(self):
+        self.commands += 1
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            _sleep(delay)
+
+    def _lookup(self, locator):
+        if locator in self._overlay:
+            return self._overlay[locator]
+        return self._states[self._state_idx].get(locator, [])
+
+    def get(self, url: str):
+        self._command()
+        if self.page_load > 0:
+            _sleep(self.page_load)
+        self.current_url = url
+        self._state_idx = 0
+        self._overlay = {}
+
+    def execute_script(self, script: str, *args):
+        if "arguments[0].click()" in script:
+            return args[0].click()
+        if "querySelectorAll" in script:
+            # `webly.scraper.NEW_ELEMENTS_SCRIPT`, one round trip like a real driver
+            by, selector, start = args
+            return self.find_elements(by, selector)[start:]
+        self._command()
+        if "scrollTo" in script:
+            self._state_idx = min(self._state_idx + 1, len(self._states) - 1)
+
+    def implicitly_wait(self, seconds: float):
+        self._command()
+
+    def quit(self):
+        self._command()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.quit()
+
+
+def _paged(total: int, per_scroll: int) -> List[int]:
+    """Number of results visible in each DOM state, the last two states are identical"""
+    counts = list(range(per_scroll, total, per_scroll)) + [total]
+    return [min(c, total) for c in counts] + [total]
+
+
+def google_recording(total: int = 100, per_scroll: int = 50) -> List[Dict]:
+    caption_xpath = (
+        "xpath:"
+        '//*[@id="Sva75c"]/div/div/div[3]/div[2]/c-wiz/div/div[1]/div[3]/div[2]/a'
+    )
+    img_xpath = (
+        "xpath:"
+        '//*[@id="Sva75c"]/div/div/div[3]/div[2]/c-wiz/div/div[1]/div[1]/div/div[2]/a/img'
+    )
+    thumbnails = [
+        {
+            "attributes": {"src": f"data:image/jpeg;base64,thumbnail{i}"},
+            "on_click": {
+                caption_xpath: [{"text": f"Google caption {i}"}],
+                img_xpath: [{"attributes": {"src": f"https://example.com/{i}.jpg"}}],
+            },
+        }
+        for i in range(total)
+    ]
+    return [
+        {"css selector:img.Q4LuWd": thumbnails[:n]} for n in _paged(total, per_scroll)
+    ]
+
+
+def yahoo_recording(total: int = 100, per_scroll: int = 60) -> List[Dict]:
+    items = [
+        {
+            "on_click": {
+                "class name:title": [{"text": f"Yahoo caption {i}"}],
+                'xpath://*[@id="img"]': [
+                    {"attributes": {"src": f"https://example.com/{i}.jpg"}}
+                ],
+            }
+        }
+        for i in range(total)
+    ]
+    states = []
+    for n in _paged(total, per_scroll):
+        sres = {"children": {"tag name:li": items[:n]}}
+        states.append(
+            {
+                'xpath://*[@id="sres"]': [sres],
+                "id:sres": [sres],
+                "css selector:#sres li": items[:n],
+            }
+        )
+    return states
+
+
+def flickr_recording(total: int = 100, per_scroll: int = 25) -> List[Dict]:
+    items = [
+        {
+            "attributes": {
+                "style": f'background-image: url("//live.staticflickr.com/65535/{i}_abc_z.jpg");'
+            },
+            "children": {
+                "class name:interaction-bar": [
+                    {"attributes": {"title": f"Flickr caption {i} by someone"}}
+                ]
+            },
+        }
+        for i in range(total)
+    ]
+    return [
+        {"xpath:/html/body/div[1]/div/main/div[2]/div/div[2]/div": items[:n]}
+        for n in _paged(total, per_scroll)
+    ]
+
+
+RECORDINGS = {
+    "google": google_recording,
+    "yahoo": yahoo_recording,
+    "flickr": flickr_recording,
+}
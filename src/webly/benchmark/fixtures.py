@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import io
+import re
+import threading
+import time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Sequence, Tuple
+
+DEFAULT_SIZES = [(64, 64), (320, 240), (1024, 768), (2048, 1536)]
+
+
+@lru_cache(maxsize=None)
+def image_bytes(width: int, height: int, fmt: str = "jpeg") -> bytes:
+    """Noisy image of the given size, noise keeps the encoded size close to real photos"""
+    import os
+
+    from PIL import Image
+
+    img = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    buffer = io.BytesIO()
+    img.save(buffer, fmt.upper())
+    return buffer.getvalue()
+
+
+class FixtureServer(object):
+    """Local HTTP server for image fixtures, runs in a background thread
+
+    Paths:
+    - `/img/<w>x<h>.jpg` or `/img/<w>x<h>.png`: generated image
+    - `/status/<code>`: empty response with that status code
+    - `/garbage.jpg`: bytes that do not decode as an image
+    """
+
+    def __init__(self, latency: float = 0.0, host: str = "127.0.0.1", port: int = 0):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if server.latency > 0:
+                    time.sleep(server.latency)
+                status, content_type, body = server.respond(self.path)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.latency = latency
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def respond(self, path: str) -> Tuple[int, str, bytes]:
+        m = re.fullmatch(r"/img/(\d+)x(\d+)\.(jpg|png)", path)
+        if m:
+            w, h, ext = int(m.group(1)), int(m.group(2)), m.group(3)
+            fmt = "jpeg" if ext == "jpg" else "png"
+            return 200, f"image/{fmt}", image_bytes(w, h, fmt)
+        m = re.fullmatch(r"/status/(\d{3})", path)
+        if m:
+            return int(m.group(1)), "text/plain", b""
+        if path == "/garbage.jpg":
+            return 200, "image/jpeg", b"not an image" * 100
+        return 404, "text/plain", b""
+
+    def image_urls(
+        self, sizes: Sequence[Tuple[int, int]] = DEFAULT_SIZES, ext: str = "jpg"
+    ) -> List[str]:
+        return [f"{self.url}/img/{w}x{h}.{ext}" for w, h in sizes]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
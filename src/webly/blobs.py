@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import os
+import urllib.parse
+from pathlib import Path
+from typing import Any, Dict, Mapping, Tuple, Union
+
+from loguru import logger
+
+# Urls of offloaded images look like `blob:sha256:<hex digest>`
+BLOB_PREFIX = "blob:sha256:"
+
+
+class LocalBlobStore(object):
+    """Content-addressed blobs in a local directory, e.g. `<root>/ab/cd/abcd...`"""
+
+    name = "local"
+
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Blob store: {self.root}")
+
+    def path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not path.is_file():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{digest}.{os.getpid()}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        return self.path(digest).read_bytes()
+
+
+class GridFSBlobStore(object):
+    """Content-addressed blobs in GridFS, the file id is the sha256 digest"""
+
+    name = "gridfs"
+
+    def __init__(self, db, bucket: str = "blobs"):
+        import gridfs
+
+        self.fs = gridfs.GridFS(db, collection=bucket)
+        logger.info(f"Blob store: GridFS {db.name}.{bucket}")
+
+    def put(self, data: bytes) -> str:
+        import gridfs.errors
+
+        digest = hashlib.sha256(data).hexdigest()
+        if not self.fs.exists(digest):
+            # Another scraper might store the same blob concurrently
+            try:
+                self.fs.put(data, _id=digest)
+            except gridfs.errors.FileExists:
+                pass
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        return self.fs.get(digest).read()
+
+
+def setup_blob_store(kind: str, blob_dir=None, db=None):
+    if kind == "none":
+        return None
+    elif kind == "local":
+        if blob_dir is None:
+            raise ValueError("Local blob store requires a blob directory")
+        return LocalBlobStore(blob_dir)
+    elif kind == "gridfs":
+        return GridFSBlobStore(db)
+    else:
+        raise ValueError(f"Invalid blob store: {kind}")
+
+
+def parse_data_url(url: str) -> Tuple[str, bytes]:
+    """Mime type and decoded bytes of a `data:` url"""
+    header, _, payload = url.partition(",")
+    mime = header[len("data:") :].split(";")[0] or "text/plain"
+    if header.endswith(";base64"):
+        return mime, base64.b64decode(payload)
+    return mime, urllib.parse.unquote_to_bytes(payload)
+
+
+def offload_inline_image(d: Mapping[str, Any], store) -> Dict[str, Any]:
+    """Replace a `data:` url with a reference to its bytes in the blob store
+
+    A `data:` url that cannot be decoded is kept, only its download will fail.
+    """
+    if not d["url"].startswith("data:"):
+        return d
+    try:
+        mime, data = parse_data_url(d["url"])
+    except ValueError as e:
+        # binascii.Error is a ValueError
+        logger.warning(f"Invalid inline image, kept as url: {e}")
+        return d
+    digest = store.put(data)
+    return {
+        **d,
+        "url": BLOB_PREFIX + digest,
+        "blob": {"store": store.name, "sha256": digest, "size": len(data), "mime": mime},
+    }
@@ -0,0 +1,599 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import re
+import shutil
+import tempfile
+import urllib.parse
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+from loguru import logger
+
+from .blobs import offload_inline_image, setup_blob_store
+from .resources import RESOURCE_PATTERNS, ResourcePolicy
+from .scraper import (
+    GOOGLE_CAPTION_XPATH,
+    GOOGLE_IMAGE_XPATH,
+    IP_INFO_URL,
+    ScrollBudget,
+    add_output_arguments,
+    file_lines,
+    flickr_caption,
+    flickr_url,
+    json_input_iterator,
+    parse_ip_info,
+    setup_db,
+    setup_output,
+    setup_seen_urls,
+    setup_stats,
+    stdin_input_iterator,
+)
+from .urls import mark_duplicate
+
+
+class CdpError(RuntimeError):
+    pass
+
+
+class Browser(object):
+    """One DevTools WebSocket connection to Chrome, shared by all tabs
+
+    Tabs are attached in flat mode: their commands and events go through the browser
+    connection, tagged with the session id of the tab.
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.ids = itertools.count(1)
+        self.pending: Dict[int, asyncio.Future] = {}
+        self.waiters: Dict[Tuple[Optional[str], str], list] = {}
+        self.reader = asyncio.ensure_future(self._read())
+
+    @classmethod
+    async def connect(cls, url: str) -> Browser:
+        import websockets
+
+        logger.info(f"DevTools connecting to: {url.split('?')[0]}")
+        return cls(await websockets.connect(url, max_size=None))
+
+    async def _read(self):
+        try:
+            async for message in self.ws:
+                msg = json.loads(message)
+                if "id" in msg:
+                    future = self.pending.pop(msg["id"], None)
+                    if future is None or future.done():
+                        continue
+                    if "error" in msg:
+                        future.set_exception(CdpError(msg["error"].get("message")))
+                    else:
+                        future.set_result(msg.get("result", {}))
+                else:
+                    key = (msg.get("sessionId"), msg["method"])
+                    for future in self.waiters.pop(key, []):
+                        if not future.done():
+                            future.set_result(msg.get("params", {}))
+        except Exception as e:
+            logger.warning(f"DevTools connection closed: {e}")
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(CdpError("DevTools connection closed"))
+
+    async def send(
+        self, method: str, params: Dict = None, session_id: Optional[str] = None
+    ) -> Dict:
+        msg = {"id": next(self.ids), "method": method, "params": params or {}}
+        if session_id is not None:
+            msg["sessionId"] = session_id
+        future = asyncio.get_event_loop().create_future()
+        self.pending[msg["id"]] = future
+        await self.ws.send(json.dumps(msg))
+        return await future
+
+    def wait_for(self, method: str, session_id: Optional[str] = None) -> asyncio.Future:
+        """Future of the next event, to be created before the command that triggers it"""
+        future = asyncio.get_event_loop().create_future()
+        self.waiters.setdefault((session_id, method), []).append(future)
+        return future
+
+    async def new_tab(self) -> Tab:
+        target = await self.send("Target.createTarget", {"url": "about:blank"})
+        attached = await self.send(
+            "Target.attachToTarget", {"targetId": target["targetId"], "flatten": True}
+        )
+        tab = Tab(self, target["targetId"], attached["sessionId"])
+        await tab.send("Page.enable")
+        await tab.send("Network.enable")
+        return tab
+
+    async def close(self):
+        self.reader.cancel()
+        await self.ws.close()
+
+
+class Tab(object):
+    def __init__(self, browser: Browser, target_id: str, session_id: str):
+        self.browser = browser
+        self.target_id = target_id
+        self.session_id = session_id
+
+    async def send(self, method: str, params: Dict = None) -> Dict:
+        return await self.browser.send(method, params, self.session_id)
+
+    async def goto(self, url: str, timeout: float = 30):
+        loaded = self.browser.wait_for("Page.loadEventFired", self.session_id)
+        result = await self.send("Page.navigate", {"url": url})
+        if "errorText" in result:
+            raise CdpError(f"Navigation to {url} failed: {result['errorText']}")
+        try:
+            await asyncio.wait_for(loaded, timeout)
+        except asyncio.TimeoutError:
+            logger.debug(f"Page load timeout, continuing: {url}")
+
+    async def evaluate(self, expression: str) -> Any:
+        """Value of a JS expression, awaited if it is a promise"""
+        result = await self.send(
+            "Runtime.evaluate",
+            {"expression": expression, "returnByValue": True, "awaitPromise": True},
+        )
+        if "exceptionDetails" in result:
+            details = result["exceptionDetails"]
+            raise CdpError(details.get("exception", {}).get("description", details))
+        return result["result"].get("value")
+
+    async def call(self, function: str, *args) -> Any:
+        """Value of a JS function called with json arguments"""
+        return await self.evaluate(f"({function})(...{json.dumps(args)})")
+
+    async def scroll_to_end(self):
+        await self.evaluate("window.scrollTo(0, document.body.scrollHeight)")
+        await asyncio.sleep(1)
+
+    async def close(self):
+        await self.browser.send("Target.closeTarget", {"targetId": self.target_id})
+
+
+# Elements matching a css selector or an xpath, shared by the scripts below
+NODES_JS = """
+const nodes = (by, selector) => {
+    if (by === 'css selector') return Array.from(document.querySelectorAll(selector));
+    const snapshot = document.evaluate(
+        selector, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+    return Array.from({length: snapshot.snapshotLength}, (_, i) => snapshot.snapshotItem(i));
+};
+const node = (xpath) => document.evaluate(
+    xpath, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+const pause = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+"""
+
+COUNT_JS = f"(by, selector) => {{ {NODES_JS} return nodes(by, selector).length; }}"
+
+GOOGLE_RESULT_JS = f"""async (index) => {{
+    {NODES_JS}
+    nodes('css selector', 'img.Q4LuWd')[index].click();
+    await pause(500);
+    const caption = node({json.dumps(GOOGLE_CAPTION_XPATH)});
+    const img = node({json.dumps(GOOGLE_IMAGE_XPATH)});
+    return {{caption: caption ? caption.innerText : null, url: img ? img.src : null}};
+}}"""
+
+YAHOO_RESULT_JS = f"""async (index) => {{
+    {NODES_JS}
+    nodes('css selector', '#sres li')[index].click();
+    await pause(500);
+    const caption = document.querySelector('.title');
+    const img = document.getElementById('img');
+    return {{
+        caption: caption ? caption.innerText : null,
+        url: img ? img.src || null : null,
+    }};
+}}"""
+
+FLICKR_RESULT_JS = f"""(xpath, index) => {{
+    {NODES_JS}
+    const item = nodes('xpath', xpath)[index];
+    const bar = item.querySelector('.interaction-bar');
+    return {{style: item.getAttribute('style'), title: bar ? bar.title : null}};
+}}"""
+
+FLICKR_RESULTS_XPATH = "/html/body/div[1]/div/main/div[2]/div/div[2]/div"
+
+
+async def iter_result_indices(
+    tab: Tab, by: str, selector: str, budget: ScrollBudget, patience: int = 1
+) -> AsyncIterator[int]:
+    """Async port of `webly.scraper.iter_result_elements`, elements stay in the page"""
+    seen = 0
+    misses = 0
+    while not budget.exhausted():
+        count = await tab.call(COUNT_JS, by, selector)
+        if count > seen:
+            misses = 0
+            for i in range(seen, count):
+                if budget.exhausted():
+                    return
+                yield i
+            seen = count
+        else:
+            misses += 1
+            if misses > patience:
+                logger.debug(f"No more results after {seen}")
+                budget.stop("exhausted")
+                return
+        if budget.exhausted():
+            return
+        await tab.scroll_to_end()
+        budget.scrolls += 1
+
+
+def search_url(base: str, query: str) -> str:
+    # Same parameters as the WebDriver engines
+    return base + urllib.parse.urlencode(
+        {"safe": "off", "tbm": "isch", "source": "hp", "q": query, "gs_l": "img"}
+    )
+
+
+async def google_images(tab: Tab, query: str, budget: ScrollBudget):
+    await tab.goto(search_url("https://www.google.com/search?", query))
+    query_datetime = datetime.utcnow()
+    async for result_index in iter_result_indices(
+        tab, "css selector", "img.Q4LuWd", budget
+    ):
+        try:
+            res = await tab.call(GOOGLE_RESULT_JS, result_index)
+        except CdpError as e:
+            logger.debug(f"Result {result_index} failed: {e}")
+            continue
+        if not res["url"] or res["url"].endswith(".gif"):
+            continue
+        budget.results += 1
+        yield {
+            "query": query,
+            "datetime_utc": query_datetime,
+            "result_index": result_index,
+            "caption": res["caption"],
+            "url": res["url"],
+        }
+
+
+async def yahoo_images(tab: Tab, query: str, budget: ScrollBudget):
+    await tab.goto(search_url("https://images.search.yahoo.com/search/images;?", query))
+    query_datetime = datetime.utcnow()
+    # Accept cookie
+    await tab.evaluate(
+        "document.querySelector('#consent-page form button')?.click() ?? null"
+    )
+    async for result_index in iter_result_indices(
+        tab, "css selector", "#sres li", budget
+    ):
+        try:
+            res = await tab.call(YAHOO_RESULT_JS, result_index)
+        except CdpError as e:
+            logger.debug(f"Result {result_index} failed: {e}")
+            continue
+        if not res["url"] or res["url"].endswith("gif"):
+            continue
+        budget.results += 1
+        yield {
+            "query": query,
+            "datetime_utc": query_datetime,
+            "result_index": result_index,
+            "caption": res["caption"],
+            "url": res["url"],
+        }
+
+
+async def flickr_images(tab: Tab, query: str, budget: ScrollBudget):
+    await tab.goto(search_url("https://www.flickr.com/search/?", query))
+    query_datetime = datetime.utcnow()
+    async for result_index in iter_result_indices(
+        tab, "xpath", FLICKR_RESULTS_XPATH, budget, patience=2
+    ):
+        try:
+            res = await tab.call(FLICKR_RESULT_JS, FLICKR_RESULTS_XPATH, result_index)
+        except CdpError as e:
+            logger.debug(f"Result {result_index} failed: {e}")
+            continue
+        url = flickr_url(res["style"])
+        if not url or res["title"] is None:
+            continue
+        budget.results += 1
+        yield {
+            "query": query,
+            "datetime_utc": query_datetime,
+            "result_index": result_index,
+            "caption": flickr_caption(res["title"]),
+            "url": url,
+        }
+
+
+ENGINES = {
+    "google": google_images,
+    "yahoo": yahoo_images,
+    "flickr": flickr_images,
+}
+
+
+async def launch_chrome(binary: str, headless: bool = True):
+    """Local Chrome process and the DevTools url of its browser target"""
+    user_data_dir = tempfile.mkdtemp(prefix="webly-chrome-")
+    args = [
+        "--remote-debugging-port=0",
+        f"--user-data-dir={user_data_dir}",
+        "--no-first-run",
+        "--no-default-browser-check",
+        "--no-sandbox",
+        "--disable-dev-shm-usage",
+    ]
+    if headless:
+        args.append("--headless")
+    process = await asyncio.create_subprocess_exec(
+        binary, *args, "about:blank", stderr=asyncio.subprocess.PIPE
+    )
+    while True:
+        line = await asyncio.wait_for(process.stderr.readline(), 30)
+        if not line:
+            raise CdpError(f"Chrome exited with code {await process.wait()}")
+        match = re.search(rb"DevTools listening on (ws://\S+)", line)
+        if match is not None:
+            url = match.group(1).decode()
+            break
+
+    async def drain_stderr():
+        while await process.stderr.readline():
+            pass
+
+    asyncio.ensure_future(drain_stderr())
+    return process, url, user_data_dir
+
+
+async def async_input_iterator(inputs):
+    """Read a blocking input iterator, e.g. stdin, without blocking the event loop"""
+    loop = asyncio.get_event_loop()
+    done = object()
+    while True:
+        d = await loop.run_in_executor(None, next, inputs, done)
+        if d is done:
+            return
+        yield d
+
+
+async def run(args):
+    if args.cdp_url is not None:
+        url = args.cdp_url
+        if args.chrome_token_file is not None:
+            token = Path(args.chrome_token_file).read_text().strip()
+            token = token.replace("TOKEN=", "", 1)
+            url += ("&" if "?" in url else "?") + f"token={token}"
+        process = None
+    elif args.chrome_binary is not None:
+        process, url, user_data_dir = await launch_chrome(
+            args.chrome_binary, not args.headful
+        )
+    else:
+        raise ValueError("Either --cdp-url or --chrome-binary is required")
+
+    browser = await Browser.connect(url)
+    resources = ResourcePolicy.from_args(args.resource_policy, args.block_resources)
+    # Up to 2 scrapes per tab are in flight, see `slots`
+    db = setup_db(args)
+    output = setup_output(args, db, 2 * args.tabs)
+    blob_store = setup_blob_store(args.blob_store, args.blob_dir, db)
+    seen = setup_seen_urls(args, db)
+    stats = setup_stats(args, db)
+
+    # Blob stores, seen urls, outputs and stats might block, e.g. on MongoDB: they run in
+    # one writer thread instead of the event loop, which also keeps them single-threaded
+    loop = asyncio.get_event_loop()
+    writer = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="writer")
+
+    def write(record: Dict) -> Dict:
+        if blob_store is not None:
+            record = offload_inline_image(record, blob_store)
+        if seen is not None:
+            record = mark_duplicate(record, seen)
+        output(record)
+        return record
+
+    tab = await browser.new_tab()
+    await tab.goto(IP_INFO_URL)
+    ip_info = parse_ip_info(await tab.evaluate("document.body.innerText"))
+    logger.info(f"IP info: {ip_info}")
+    tabs: asyncio.Queue = asyncio.Queue()
+    tabs.put_nowait(tab)
+    for _ in range(args.tabs - 1):
+        tabs.put_nowait(await browser.new_tab())
+    logger.info(f"Scraping with {args.tabs} tabs")
+
+    async def scrape(d: Dict, engine: str):
+        tab = await tabs.get()
+        budget = ScrollBudget(args.num_images, args.query_seconds)
+        duplicates = 0
+        try:
+            patterns = [
+                p
+                for c in resources.blocked.get(engine, [])
+                for p in RESOURCE_PATTERNS[c]
+            ]
+            await tab.send("Network.setBlockedURLs", {"urls": patterns})
+            async for res in ENGINES[engine](tab, d["query"], budget):
+                record = {**d, **res, "engine": engine, "public_ip": ip_info}
+                record = await loop.run_in_executor(writer, write, record)
+                duplicates += record.get("duplicate", False)
+        except Exception as e:
+            budget.stop("error")
+            logger.warning(f'Error scraping {engine}: {d["query"]}: {e}')
+            # The tab might be unusable, e.g. crashed
+            with logger.catch(Exception, reraise=False):
+                await tab.close()
+            tab = await browser.new_tab()
+        finally:
+            budget.stop("closed")
+            tabs.put_nowait(tab)
+            logger.debug(f'Scraped {engine}: {d["query"]}, {budget.summary()}')
+            if stats is not None:
+                await loop.run_in_executor(
+                    writer,
+                    partial(
+                        stats.record,
+                        d,
+                        engine,
+                        budget.results,
+                        {
+                            "duplicates": duplicates,
+                            "scrolls": budget.scrolls,
+                            f"stopped_{budget.reason}": 1,
+                        },
+                    ),
+                )
+
+    lines = file_lines(args.input_file) if args.input_file is not None else None
+    if args.input == "text":
+        inputs = stdin_input_iterator(lines)
+    elif args.input == "json":
+        inputs = json_input_iterator(lines)
+    else:
+        raise ValueError(f"Invalid --input: {args.input}")
+
+    # Read no further ahead than the tabs can take, so stdin is consumed as it is scraped
+    slots = asyncio.Semaphore(2 * args.tabs)
+    tasks = set()
+    try:
+        async for d in async_input_iterator(inputs):
+            for engine in args.engines:
+                await slots.acquire()
+                task = asyncio.ensure_future(scrape(d, engine))
+                task.add_done_callback(lambda _: slots.release())
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        if hasattr(output, "close"):
+            await loop.run_in_executor(writer, output.close)
+        writer.shutdown()
+        await browser.close()
+        if process is not None:
+            process.terminate()
+            await process.wait()
+            shutil.rmtree(user_data_dir, ignore_errors=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="DevTools scraper")
+
+    inputs = parser.add_argument_group("Input options")
+    inputs.add_argument("--input", choices=["text", "json"], default="text")
+    inputs.add_argument(
+        "--input-file",
+        type=str,
+        help="read inputs from this file instead of stdin",
+        default=None,
+    )
+
+    add_output_arguments(parser)
+
+    scraping = parser.add_argument_group("Scraping options")
+    scraping.add_argument(
+        "--engines",
+        choices=list(ENGINES),
+        help="engines, e.g. google yahoo",
+        nargs="+",
+        required=True,
+    )
+    scraping.add_argument(
+        "--num-images",
+        type=int,
+        help="max number of images per query",
+        default=20,
+    )
+    scraping.add_argument(
+        "--query-seconds",
+        type=float,
+        help="time budget per query and engine, scraping stops after it",
+        default=120,
+    )
+    scraping.add_argument(
+        "--tabs",
+        type=int,
+        help="concurrent tabs, each one scrapes one query and engine at a time",
+        default=8,
+    )
+
+    chrome = parser.add_argument_group("Chrome options")
+    chrome.add_argument(
+        "--cdp-url",
+        type=str,
+        help="DevTools WebSocket url of a running browser, e.g. 'ws://localhost:3000'",
+        default=None,
+    )
+    chrome.add_argument(
+        "--chrome-token-file",
+        type=str,
+        help="Only needed for remote Chrome",
+        default=None,
+    )
+    chrome.add_argument(
+        "--chrome-binary",
+        type=str,
+        help="launch this local Chrome instead of connecting to --cdp-url",
+        default=None,
+    )
+    chrome.add_argument(
+        "--headful", action="store_true", help="show the local Chrome window"
+    )
+    chrome.add_argument(
+        "--resource-policy",
+        choices=["off", "default"],
+        help="block page resources that the engines do not need, e.g. fonts and trackers",
+        default="default",
+    )
+    chrome.add_argument(
+        "--block-resources",
+        type=str,
+        nargs="+",
+        metavar="ENGINE=CATEGORIES",
+        help="override the blocked resources of an engine, e.g. google=fonts,media",
+        default=None,
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        logger.info("Interrupted: stop scraping")
+
+
+"""
+python -m webly.cdp \
+    --engines google yahoo flickr \
+    --chrome-binary /usr/bin/chromium \
+    --tabs 16 \
+    --input text \
+    --output json
+
+python -m webly.cdp \
+    --engines google yahoo flickr \
+    --cdp-url ws://localhost:3000 \
+    --chrome-token-file .secrets/chrome_token \
+    --tabs 16 \
+    --input-file queries.txt \
+    --input text \
+    --output mongo \
+    --mongo-url mongodb://user@localhost \
+    --mongo-pass-file .secrets/mongo_initdb_root_password
+"""
+if __name__ == "__main__":
+    main()
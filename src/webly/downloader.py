@@ -1,15 +1,25 @@
 import argparse
 import base64
 import io
+import os
 import random
+import socket
+import time
+import urllib.parse
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Any, Mapping, Union
+from typing import Any, Dict, List, Mapping, Optional, Tuple, Union
 
 import requests
 from loguru import logger
 from PIL import Image
 
+from .blobs import BLOB_PREFIX, setup_blob_store
 from .mongo import setup_mongo
+from .schema import flatten_query
+from .urls import canonicalize_url
 
 user_agents = [
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/13.1.1 Safari/605.1.15",
@@ -22,7 +32,9 @@ user_agents = [
 ]
 
 
-def download_image(img_dict: Mapping[str, Any], path: Union[str, Path], force=False):
+def download_image(
+    img_dict: Mapping[str, Any], path: Union[str, Path], force=False, blob_store=None
+):
     path = Path(path)
     path.parent.mkdir(parents=True, exist_ok=True)
 
@@ -40,6 +52,14 @@ def download_image(img_dict: Mapping[str, Any], path: Union[str, Path], force=Fa
         img = img.convert("RGB")
         with path.open("wb") as f:
             img.save(f, "JPEG", quality=95)
+    elif img_dict["url"].startswith(BLOB_PREFIX):
+        if blob_store is None:
+            raise ValueError(f"Blob store required for: {img_dict['url']}")
+        data = blob_store.get(img_dict["url"][len(BLOB_PREFIX) :])
+        img = Image.open(io.BytesIO(data))
+        img = img.convert("RGB")
+        with path.open("wb") as f:
+            img.save(f, "JPEG", quality=95)
     elif img_dict["url"].startswith("data"):
         base64_img = img_dict["url"].split(",")[1]
         img = Image.open(io.BytesIO(base64.b64decode(base64_img)))
@@ -50,6 +70,204 @@ def download_image(img_dict: Mapping[str, Any], path: Union[str, Path], force=Fa
         raise ValueError(f"Invalid image url: {img_dict['url']}")
 
 
+class Leases(object):
+    """Batches of documents leased to one downloader through their `download` field
+
+    A document is claimable while it has no `download.status`, or while its lease is
+    expired, e.g. because the worker holding it died or deferred it. Claims are atomic
+    per document, so that no document is leased to two workers at once.
+    With the normalized schema, a document is a query with all of its results.
+    """
+
+    def __init__(self, collection, worker_id: str, lease_seconds: float = 600):
+        self.collection = collection
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.collection.create_index(
+            [("download.status", 1), ("download.lease_until", 1)]
+        )
+        self.collection.create_index("download.lease", sparse=True)
+
+    def claimable(self, now: datetime) -> Dict:
+        return {
+            "$or": [
+                {"download.status": None},
+                {
+                    "download.status": {"$in": ["leased", "deferred"]},
+                    "download.lease_until": {"$lt": now},
+                },
+            ],
+            # References to an image seen before have nothing to download
+            "duplicate": {"$ne": True},
+        }
+
+    def claim(self, batch_size: int) -> List[Dict]:
+        """Up to `batch_size` documents, empty only if nothing is claimable
+
+        Each document is claimed with its own find-and-modify, so concurrent workers
+        never lose a whole batch to the first one and each get the next free documents.
+        """
+        from pymongo import ReturnDocument
+
+        now = datetime.utcnow()
+        lease = uuid.uuid4().hex
+        batch = []
+        for _ in range(batch_size):
+            doc = self.collection.find_one_and_update(
+                self.claimable(now),
+                {
+                    "$set": {
+                        "download.status": "leased",
+                        "download.lease": lease,
+                        "download.lease_until": now
+                        + timedelta(seconds=self.lease_seconds),
+                        "download.worker": self.worker_id,
+                    },
+                    "$inc": {"download.attempts": 1},
+                },
+                return_document=ReturnDocument.AFTER,
+            )
+            if doc is None:
+                break
+            batch.append(doc)
+        return batch
+
+    def renew(self, lease: str):
+        self.collection.update_many(
+            {"download.lease": lease, "download.status": "leased"},
+            {
+                "$set": {
+                    "download.lease_until": datetime.utcnow()
+                    + timedelta(seconds=self.lease_seconds)
+                }
+            },
+        )
+
+    def finish(self, img_dict: Mapping[str, Any], status: str, **fields):
+        """Set the final status of a document, unless its lease was lost meanwhile"""
+        self.collection.update_one(
+            {"_id": img_dict["_id"], "download.lease": img_dict["download"]["lease"]},
+            {
+                "$set": {
+                    "download.status": status,
+                    "download.finished_utc": datetime.utcnow(),
+                    **{f"download.{k}": v for k, v in fields.items()},
+                },
+                "$unset": {"download.lease": "", "download.lease_until": ""},
+            },
+        )
+
+    def defer(self, img_dict: Mapping[str, Any], until: datetime):
+        """Give a document back, to be claimed again after `until`"""
+        self.collection.update_one(
+            {"_id": img_dict["_id"], "download.lease": img_dict["download"]["lease"]},
+            {
+                "$set": {"download.status": "deferred", "download.lease_until": until},
+                "$unset": {"download.lease": ""},
+            },
+        )
+
+    def retry_failed(self):
+        result = self.collection.update_many(
+            {"download.status": "failed"}, {"$unset": {"download.status": ""}}
+        )
+        logger.info(f"Retrying {result.modified_count} failed downloads")
+
+
+# HTTP statuses after which a url is not worth trying again
+PERMANENT_STATUSES = (400, 401, 403, 404, 410, 451)
+
+
+def classify_failure(e: Exception) -> Tuple[str, str]:
+    """Reason of a failed download, and its kind: `permanent`, `host` or `other`"""
+    from PIL import UnidentifiedImageError
+
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        status = e.response.status_code
+        if status in PERMANENT_STATUSES:
+            return f"http_{status}", "permanent"
+        if status == 429 or status >= 500:
+            return f"http_{status}", "host"
+        return f"http_{status}", "other"
+    if isinstance(e, requests.Timeout):
+        return "timeout", "host"
+    if isinstance(e, requests.ConnectionError):
+        return "connection", "host"
+    if isinstance(e, UnidentifiedImageError):
+        return "undecodable", "permanent"
+    if isinstance(e, ValueError) and "Invalid image url" in str(e):
+        return "invalid_url", "permanent"
+    return type(e).__name__, "other"
+
+
+class HostCircuitBreaker(object):
+    """Skip the urls of hosts that keep failing
+
+    After `max_failures` consecutive connection errors, timeouts or server errors, the
+    circuit of a host opens and its urls are skipped for `cooldown` seconds. Then a
+    single probe is let through (half-open): if the host answers the circuit closes,
+    otherwise it opens for another `cooldown`.
+    """
+
+    def __init__(self, max_failures: int = 5, cooldown: float = 120):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.failures: Dict[str, int] = {}
+        self.open_until: Dict[str, float] = {}
+        self.probing = set()
+
+    def allow(self, host: str) -> bool:
+        if host not in self.open_until:
+            return True
+        if host in self.probing or time.time() < self.open_until[host]:
+            return False
+        logger.info(f"Host {host} half-open, probing")
+        self.probing.add(host)
+        return True
+
+    def retry_at(self, host: str) -> float:
+        """When the next probe of an open host can be sent"""
+        return self.open_until.get(host, time.time())
+
+    def success(self, host: str):
+        if host in self.open_until:
+            logger.info(f"Host {host} closed")
+        self.failures.pop(host, None)
+        self.open_until.pop(host, None)
+        self.probing.discard(host)
+
+    def failure(self, host: str):
+        self.failures[host] = self.failures.get(host, 0) + 1
+        if host in self.probing or self.failures[host] >= self.max_failures:
+            self.probing.discard(host)
+            self.open_until[host] = time.time() + self.cooldown
+            logger.warning(
+                f"Host {host} open for {self.cooldown}s "
+                f"after {self.failures[host]} consecutive failures"
+            )
+
+
+class NegativeCache(object):
+    """Canonical urls that failed permanently, e.g. 404 or undecodable, in `webly.bad_urls`"""
+
+    def __init__(self, db):
+        self.collection = db["bad_urls"]
+
+    def get(self, url: str) -> Optional[str]:
+        doc = self.collection.find_one({"_id": canonicalize_url(url)}, {"reason": 1})
+        return doc["reason"] if doc is not None else None
+
+    def add(self, url: str, reason: str):
+        self.collection.update_one(
+            {"_id": canonicalize_url(url)},
+            {
+                "$set": {"reason": reason, "utc": datetime.utcnow()},
+                "$inc": {"count": 1},
+            },
+            upsert=True,
+        )
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description="Scraper")
 
@@ -63,10 +281,76 @@ def parse_args():
         help="password file for database connections",
         required=True,
     )
+    inputs.add_argument(
+        "--schema",
+        choices=["flat", "normalized"],
+        help="schema of the scraped documents, see `webly.scraper --schema`",
+        default="flat",
+    )
+    inputs.add_argument(
+        "--blob-store",
+        choices=["none", "local", "gridfs"],
+        help="where the scraper stored inline images, see `webly.scraper --blob-store`",
+        default="none",
+    )
+    inputs.add_argument(
+        "--blob-dir",
+        type=str,
+        help="directory for --blob-store local",
+        default=None,
+    )
 
     output = parser.add_argument_group("Output options")
     output.add_argument("--output-dir", type=Path, required=True)
 
+    workers = parser.add_argument_group("Worker options")
+    workers.add_argument(
+        "--worker-id",
+        type=str,
+        help="name of this downloader in the leases, defaults to host:pid",
+        default=None,
+    )
+    workers.add_argument(
+        "--batch-size",
+        type=int,
+        help="documents claimed per lease, each query document holds many images",
+        default=100,
+    )
+    workers.add_argument(
+        "--lease-seconds",
+        type=float,
+        help="after this many seconds without renewal, other workers reclaim a batch",
+        default=600,
+    )
+    workers.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="make documents whose download failed claimable again",
+    )
+    workers.add_argument(
+        "--host-max-failures",
+        type=int,
+        help="skip the urls of a host after this many consecutive failures",
+        default=5,
+    )
+    workers.add_argument(
+        "--host-cooldown",
+        type=float,
+        help="seconds before a failing host is probed again",
+        default=120,
+    )
+    workers.add_argument(
+        "--ignore-negative-cache",
+        action="store_true",
+        help="try again urls that failed permanently, e.g. with 404",
+    )
+    workers.add_argument(
+        "--wait",
+        type=float,
+        help="poll for new documents every this many seconds instead of exiting",
+        default=None,
+    )
+
     return parser.parse_args()
 
 
@@ -74,23 +358,103 @@ def main():
     args = parse_args()
     args.output_dir.mkdir(exist_ok=True, parents=True)
     collection = setup_mongo(args.mongo_url, args.mongo_pass_file)
+    blob_store = setup_blob_store(args.blob_store, args.blob_dir, collection.database)
+    if args.schema == "normalized":
+        collection = collection.database["queries"]
+
+    worker_id = args.worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    leases = Leases(collection, worker_id, args.lease_seconds)
+    if args.retry_failed:
+        leases.retry_failed()
+
+    breaker = HostCircuitBreaker(args.host_max_failures, args.host_cooldown)
+    negative = NegativeCache(collection.database)
+
+    counts = Counter()
+    try:
+        while True:
+            batch = leases.claim(args.batch_size)
+            if len(batch) == 0:
+                if args.wait is None:
+                    break
+                time.sleep(args.wait)
+                continue
+            logger.info(f"Worker {worker_id} leased {len(batch)} documents")
+            renewed = time.monotonic()
+            for doc in batch:
+                # Renew well before expiry, a batch can take longer than one lease
+                if time.monotonic() - renewed > args.lease_seconds / 2:
+                    leases.renew(doc["download"]["lease"])
+                    renewed = time.monotonic()
+                if args.schema == "normalized":
+                    records = [r for r in flatten_query(doc) if not r.get("duplicate")]
+                else:
+                    records = [doc]
+                errors = []
+                retry_at = None
+                for img_dict in records:
+                    path = args.output_dir / f'{img_dict["_id"]}.jpg'
+                    if path.is_file():
+                        logger.info(f"Existing: {path}")
+                        counts["done"] += 1
+                        continue
+                    url = img_dict["url"]
+                    reason = None if args.ignore_negative_cache else negative.get(url)
+                    if reason is not None:
+                        logger.debug(f"Skipped, {reason} before: {url[:100]}")
+                        errors.append(reason)
+                        counts[f"skipped: {reason}"] += 1
+                        continue
+                    host = urllib.parse.urlsplit(url).hostname
+                    if host is not None and not breaker.allow(host):
+                        retry_at = max(retry_at or 0, breaker.retry_at(host))
+                        counts["skipped: host open"] += 1
+                        continue
+                    try:
+                        download_image(img_dict, path, blob_store=blob_store)
+                        logger.info(f"Saved: {path}")
+                        counts["done"] += 1
+                        if host is not None:
+                            breaker.success(host)
+                    except Exception as e:
+                        reason, kind = classify_failure(e)
+                        logger.warning(f"Image download failed ({reason}): {e}")
+                        errors.append(reason)
+                        counts[f"failed: {reason}"] += 1
+                        if kind == "permanent":
+                            negative.add(url, reason)
+                        if host is not None:
+                            if kind == "host":
+                                breaker.failure(host)
+                            else:
+                                breaker.success(host)
+                if retry_at is not None:
+                    leases.defer(doc, datetime.utcfromtimestamp(retry_at))
+                elif len(errors) > 0:
+                    leases.finish(doc, "failed", error=errors[-1], failures=len(errors))
+                else:
+                    leases.finish(doc, "done")
+    except KeyboardInterrupt:
+        logger.info(
+            "Interrupted: unfinished documents are reclaimed once leases expire"
+        )
+    summary = "\n".join(f"  {k}: {v}" for k, v in sorted(counts.items()))
+    logger.info(f"Worker {worker_id}:\n{summary}")
 
-    for img_dict in collection.find():
-        try:
-            path = args.output_dir / f'{img_dict["_id"]}.jpg'
-            if path.is_file():
-                logger.info(f"Existing: {path}")
-            else:
-                download_image(img_dict, path)
-                logger.info(f"Saved: {path}")
-        except Exception as e:
-            logger.warning(f"Image download failed: {e}")
 
 """
 python -m webly.downloader \
     --mongo-url mongodb://user@localhost \
     --mongo-pass-file .secrets/mongo_initdb_root_password \
     --output-dir images
+
+# Any number of downloaders, on any machines sharing the output directory
+python -m webly.downloader \
+    --mongo-url mongodb://user@localhost \
+    --mongo-pass-file .secrets/mongo_initdb_root_password \
+    --output-dir images \
+    --batch-size 50 \
+    --lease-seconds 300
 """
 if __name__ == "__main__":
     main()
@@ -9,7 +9,13 @@ from typing import Iterator, NamedTuple, Sequence, Tuple, Union
 
 from loguru import logger
 
-from .rabbit import declare_expand_queue, declare_scrape_queue, setup_rabbitmq
+from .rabbit import (
+    add_backpressure_arguments,
+    declare_expand_queue,
+    declare_scrape_queue,
+    setup_backpressure,
+    setup_rabbitmq,
+)
 
 
 class Expander(object):
@@ -124,6 +130,12 @@ def parse_args():
         default=None,
     )
 
+    add_expander_arguments(parser)
+    add_backpressure_arguments(parser)
+    return parser.parse_args()
+
+
+def add_expander_arguments(parser):
     ngrams = parser.add_argument_group("Ngram options")
     ngrams.add_argument(
         "--ngrams-dir",
@@ -152,7 +164,6 @@ def parse_args():
         help="languages, e.g. se fr it",
         default=None,
     )
-    return parser.parse_args()
 
 
 def stdin_input_iterator():
@@ -167,12 +178,24 @@ def json_input_iterator():
         yield json.loads(line)
 
 
-def rabbit_input_iterator(channel):
+def rabbit_input_iterator(channel, backpressure=None):
+    """Fetch predicates one at a time, pausing for `backpressure` between them
+
+    Messages are fetched with `basic_get` instead of a consumer, so that no delivery is
+    prefetched and left unacked while the downstream queue drains, which could take
+    longer than the broker's consumer timeout.
+    """
     queue = declare_expand_queue(channel)
     logger.info(f"Receiving predicates from queue `{queue}`")
 
     try:
-        for method, properties, body in channel.consume(queue=queue, auto_ack=False):
+        while True:
+            if backpressure is not None:
+                backpressure.pause()
+            method, properties, body = channel.basic_get(queue=queue, auto_ack=False)
+            if method is None:
+                channel.connection.sleep(1)
+                continue
             try:
                 yield json.loads(body)
                 channel.basic_ack(delivery_tag=method.delivery_tag)
@@ -183,8 +206,6 @@ def rabbit_input_iterator(channel):
         logger.info("Interrupted: stop receiving messages")
     except Exception as e:
         logger.exception("Error while receiving msg", e)
-    finally:
-        channel.cancel()
 
 
 def stdout_output(d):
@@ -195,13 +216,15 @@ def json_output(d):
     print(json.dumps(d))
 
 
-def rabbit_output(channel):
+def rabbit_output(channel, backpressure=None):
     import pika
 
     queue = declare_scrape_queue(channel)
     logger.info(f"Pushing queries to queue `{queue}`")
 
     def output(msg):
+        if backpressure is not None:
+            backpressure.wait()
         msg = json.dumps(msg)
         channel.basic_publish(
             exchange="webly",
@@ -224,15 +247,18 @@ def main():
         languages=args.languages,
     )
 
+    backpressure = None
     if args.input == "amqp" or args.output == "amqp":
         channel = setup_rabbitmq(args.amqp_url, args.amqp_pass_file)
+    if args.output == "amqp":
+        backpressure = setup_backpressure(channel, declare_scrape_queue(channel), args)
 
     if args.input == "text":
         inputs = stdin_input_iterator()
     elif args.input == "json":
         inputs = json_input_iterator()
     elif args.input == "amqp":
-        inputs = rabbit_input_iterator(channel)
+        inputs = rabbit_input_iterator(channel, backpressure)
     else:
         raise ValueError(f"Invalid --input: {args.input}")
 
@@ -241,7 +267,8 @@ def main():
     elif args.output == "json":
         output = json_output
     elif args.output == "amqp":
-        output = rabbit_output(channel)
+        # With amqp input, pause between predicates only, never while holding one
+        output = rabbit_output(channel, backpressure if args.input != "amqp" else None)
     else:
         raise ValueError(f"Invalid --output: {args.output}")
 
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import argparse
+import fcntl
+import json
+import os
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple, Union
+
+from loguru import logger
+
+
+class Journal(object):
+    """Append-only progress journal of finished (query, engine) pairs
+
+    Each finished pair is one json line, appended with a single `write` on a file opened
+    with `O_APPEND`, so several workers can share the same journal. Appends hold a shared
+    lock, `compact` holds an exclusive lock and atomically replaces the file.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.done = set()
+        self.refresh()
+        logger.info(f"Journal {self.path}: {len(self.done)} finished (query, engine)")
+
+    def refresh(self):
+        """Load all pairs finished so far, including those of other workers"""
+        if not self.path.is_file():
+            return
+        with self.path.open("rb") as f:
+            data = f.read()
+        # A concurrent append might not be complete yet, ignore the trailing partial line
+        for line in data[: data.rfind(b"\n") + 1].splitlines():
+            if line.strip():
+                d = json.loads(line)
+                self.done.add((d["query"], d["engine"]))
+
+    def __contains__(self, pair: Tuple[str, str]) -> bool:
+        return pair in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def add(self, query: str, engine: str):
+        if (query, engine) in self.done:
+            return
+        line = json.dumps({"query": query, "engine": engine}).encode() + b"\n"
+        while True:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                # The journal was compacted while we waited for the lock, reopen it
+                if os.fstat(fd).st_ino != os.stat(self.path).st_ino:
+                    continue
+                os.write(fd, line)
+                break
+            finally:
+                os.close(fd)
+        self.done.add((query, engine))
+
+    def compact(self) -> int:
+        """Rewrite the journal without duplicate lines, return the number of pairs"""
+        with self.path.open("rb") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            lines = f.read().splitlines(keepends=True)
+            pairs = {}
+            for line in lines:
+                if line.endswith(b"\n"):
+                    d = json.loads(line)
+                    pairs[(d["query"], d["engine"])] = line
+
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with tmp.open("wb") as t:
+                t.writelines(pairs.values())
+                t.flush()
+                os.fsync(t.fileno())
+            os.replace(tmp, self.path)
+        logger.info(f"Compacted {self.path}: {len(lines)} lines -> {len(pairs)} pairs")
+        self.done = set(pairs)
+        return len(pairs)
+
+
+def iter_lines(
+    path: Union[str, Path], start: int = 0, end: Optional[int] = None
+) -> Iterator[str]:
+    """Lines that start within the byte range [start, end) of a file
+
+    Consecutive ranges partition the lines of the file, so several workers can read
+    the same input file without coordination, see `split_ranges`.
+    """
+    with open(path, "rb") as f:
+        if start > 0:
+            f.seek(start - 1)
+            if f.read(1) != b"\n":
+                f.readline()
+        while end is None or f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode()
+
+
+def split_ranges(path: Union[str, Path], workers: int) -> List[Tuple[int, int]]:
+    """Split a file into byte ranges of roughly equal size, one per worker"""
+    size = Path(path).stat().st_size
+    bounds = [size * i // workers for i in range(workers + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Scraper progress journal")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compact = commands.add_parser("compact", help="remove duplicate lines")
+    compact.add_argument("journal", type=Path)
+
+    ranges = commands.add_parser("ranges", help="print one byte range per worker")
+    ranges.add_argument("input_file", type=Path)
+    ranges.add_argument("--workers", type=int, required=True)
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.command == "compact":
+        Journal(args.journal).compact()
+    elif args.command == "ranges":
+        for start, end in split_ranges(args.input_file, args.workers):
+            print(start, end)
+
+
+"""
+python -m webly.journal ranges queries.txt --workers 2
+
+python -m webly.scraper \
+    --engines google yahoo flickr \
+    --chrome-url http://localhost:3000/webdriver \
+    --chrome-token-file .secrets/chrome_token \
+    --input text \
+    --input-file queries.txt \
+    --input-range 0 1024 \
+    --journal progress.jsonl \
+    --output json
+
+python -m webly.journal compact progress.jsonl
+"""
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import argparse
+import queue
+import threading
+from typing import Callable, Iterable, List
+
+from loguru import logger
+
+from .blobs import setup_blob_store
+from .expander import Expander, add_expander_arguments
+from .predicates import iter_predicates
+from .scraper import (
+    add_output_arguments,
+    add_scraping_arguments,
+    driver_helper,
+    scrape,
+    session,
+    setup_db,
+    setup_output,
+    setup_seen_urls,
+    setup_stats,
+)
+
+# Sent downstream once per worker of the next stage when a stage is done
+STOP = object()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Single-node pipeline")
+
+    inputs = parser.add_argument_group("Input options")
+    inputs.add_argument("predicates", nargs="+")
+
+    pipeline = parser.add_argument_group("Pipeline options")
+    pipeline.add_argument(
+        "--expand-workers",
+        type=int,
+        help="expander threads",
+        default=1,
+    )
+    pipeline.add_argument(
+        "--scrape-workers",
+        type=int,
+        help="scraper threads, each one drives its own Chrome session",
+        default=1,
+    )
+    pipeline.add_argument(
+        "--queue-size",
+        type=int,
+        help="max items waiting between two stages, upstream stages block when full",
+        default=100,
+    )
+
+    add_expander_arguments(parser)
+    add_output_arguments(parser)
+    add_scraping_arguments(parser)
+
+    return parser.parse_args()
+
+
+class Stage(object):
+    """Worker threads that map each item of `inbox` to zero or more items of `outbox`"""
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[object], Iterable],
+        inbox: queue.Queue,
+        outbox: queue.Queue,
+        workers: int,
+        downstream_workers: int,
+    ):
+        self.name = name
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.downstream_workers = downstream_workers
+        self.running = workers
+        self.lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self.work, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+        return self
+
+    def work(self):
+        try:
+            while True:
+                item = self.inbox.get()
+                if item is STOP:
+                    break
+                try:
+                    for out in self.fn(item):
+                        self.outbox.put(out)
+                except Exception as e:
+                    logger.exception(f"Error in stage {self.name}", e)
+        finally:
+            with self.lock:
+                self.running -= 1
+                last = self.running == 0
+            if last:
+                logger.debug(f"Stage {self.name} done")
+                for _ in range(self.downstream_workers):
+                    self.outbox.put(STOP)
+
+
+def main():
+    args = parse_args()
+
+    expander = Expander(
+        ngrams_dir=args.ngrams_dir,
+        ngrams=args.ngrams,
+        ngrams_max=args.ngrams_max,
+        languages=args.languages,
+    )
+    chrome = driver_helper(args)
+    db = setup_db(args)
+    output = setup_output(args, db, args.scrape_workers)
+    stats = setup_stats(args, db)
+    blob_store = setup_blob_store(args.blob_store, args.blob_dir, db)
+    seen = setup_seen_urls(args, db)
+
+    def expand(d):
+        for expansion, query in expander.expand(d["predicate"]):
+            yield {**d, "expansion": expansion, "query": query}
+
+    def scrape_all(d):
+        with session(chrome) as (driver, proxy, ip_info):
+            for engine in args.engines:
+                yield from scrape(
+                    chrome,
+                    driver,
+                    proxy,
+                    ip_info,
+                    d,
+                    engine,
+                    args.num_images,
+                    blob_store,
+                    seen,
+                    query_seconds=args.query_seconds,
+                    stats=stats,
+                )
+
+    predicates = queue.Queue(maxsize=args.queue_size)
+    queries = queue.Queue(maxsize=args.queue_size)
+    records = queue.Queue(maxsize=args.queue_size)
+    stages: List[Stage] = [
+        Stage(
+            "expand",
+            expand,
+            predicates,
+            queries,
+            args.expand_workers,
+            args.scrape_workers,
+        ),
+        Stage("scrape", scrape_all, queries, records, args.scrape_workers, 1),
+    ]
+    for stage in stages:
+        stage.start()
+
+    def produce():
+        for d in iter_predicates(args.predicates):
+            predicates.put(d)
+        for _ in range(args.expand_workers):
+            predicates.put(STOP)
+
+    threading.Thread(target=produce, name="predicates", daemon=True).start()
+
+    # Records are written from the main thread only, outputs need not be thread-safe
+    try:
+        while True:
+            d = records.get()
+            if d is STOP:
+                break
+            output(d)
+    except KeyboardInterrupt:
+        logger.info("Interrupted: stop writing records")
+    finally:
+        if hasattr(output, "close"):
+            output.close()
+        chrome.close()
+
+
+"""
+python -m webly.pipeline \
+    --ngrams 4 5 \
+    --ngrams-dir data/ngrams/processed \
+    --ngrams-max 2 \
+    --engines google yahoo flickr \
+    --scrape-workers 4 \
+    --chrome-url http://localhost:3000/webdriver \
+    --chrome-token-file .secrets/chrome_token \
+    --output ndjson \
+    --output-dir results \
+    data/vrd/predicates.txt
+"""
+if __name__ == "__main__":
+    main()
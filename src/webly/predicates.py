@@ -5,7 +5,12 @@ import json
 
 from loguru import logger
 
-from .rabbit import declare_expand_queue, setup_rabbitmq
+from .rabbit import (
+    add_backpressure_arguments,
+    declare_expand_queue,
+    setup_backpressure,
+    setup_rabbitmq,
+)
 
 
 def parse_args():
@@ -32,6 +37,7 @@ def parse_args():
         help="password file for amqp connections",
         default=None,
     )
+    add_backpressure_arguments(parser)
 
     return parser.parse_args()
 
@@ -44,13 +50,16 @@ def json_output(d):
     print(json.dumps(d))
 
 
-def rabbit_output(channel):
+def rabbit_output(channel, args):
     import pika
 
     queue = declare_expand_queue(channel)
     logger.info(f"Pushing predicates to queue `{queue}`")
+    backpressure = setup_backpressure(channel, queue, args)
 
     def output(msg):
+        if backpressure is not None:
+            backpressure.wait()
         msg = json.dumps(msg)
         channel.basic_publish(
             exchange="webly",
@@ -63,6 +72,19 @@ def rabbit_output(channel):
     return output
 
 
+def iter_predicates(sources):
+    """Predicates from the command line, `.txt` arguments are read one predicate per line"""
+    for p in sources:
+        if p.endswith(".txt"):
+            with open(p) as f:
+                for line in f:
+                    line = line.strip()
+                    if len(line) > 0 and not line.startswith("#"):
+                        yield {"predicate": line}
+        else:
+            yield {"predicate": p}
+
+
 def main():
     args = parse_args()
 
@@ -72,19 +94,12 @@ def main():
         output = json_output
     elif args.output == "amqp":
         channel = setup_rabbitmq(args.amqp_url, args.amqp_pass_file)
-        output = rabbit_output(channel)
+        output = rabbit_output(channel, args)
     else:
         raise ValueError(f"Invalid --output: {args.output}")
 
-    for p in args.predicates:
-        if p.endswith(".txt"):
-            with open(p) as f:
-                for line in f:
-                    line = line.strip()
-                    if len(line) > 0 and not line.startswith("#"):
-                        output({"predicate": line})
-        else:
-            output({"predicate": p})
+    for d in iter_predicates(args.predicates):
+        output(d)
 
 
 """
@@ -0,0 +1,306 @@
+from __future__ import annotations
+
+import argparse
+import random
+import select
+import socket
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from loguru import logger
+
+
+class ProxyStats(object):
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.total_latency = 0.0
+        self.blocked_until = 0.0
+        self.ip_info: Optional[Dict[str, str]] = None
+        self.checked_at = 0.0
+
+    @property
+    def success_rate(self) -> float:
+        # Laplace smoothing, so that unused proxies get a fair share of traffic
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    @property
+    def mean_latency(self) -> float:
+        n = self.successes + self.failures
+        return self.total_latency / n if n > 0 else float("nan")
+
+
+class ProxyPool(object):
+    """Egress proxies with per-proxy health, picked at random weighted by success rate
+
+    A proxy is blocked for `cooldown` seconds after `max_failures` consecutive failures,
+    or immediately when an engine is detected to block it. Its identity (IP info) is
+    checked again after `check_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        proxies: Sequence[str],
+        max_failures: int = 3,
+        cooldown: float = 600,
+        check_interval: float = 3600,
+    ):
+        if len(proxies) == 0:
+            raise ValueError("Empty proxy pool")
+        self.stats = {p: ProxyStats() for p in proxies}
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.reports = 0
+        logger.info(f"Proxy pool: {len(proxies)} proxies")
+
+    @classmethod
+    def from_file(cls, path, **kwargs) -> ProxyPool:
+        lines = Path(path).read_text().splitlines()
+        proxies = [l.strip() for l in lines if l.strip() and not l.startswith("#")]
+        return cls(proxies, **kwargs)
+
+    def __len__(self):
+        return len(self.stats)
+
+    def acquire(self) -> str:
+        now = time.time()
+        with self.lock:
+            healthy = [p for p, s in self.stats.items() if s.blocked_until <= now]
+            if len(healthy) == 0:
+                proxy = min(self.stats, key=lambda p: self.stats[p].blocked_until)
+                logger.warning(f"All proxies blocked, using {proxy}")
+                return proxy
+            weights = [self.stats[p].success_rate for p in healthy]
+            return random.choices(healthy, weights=weights)[0]
+
+    def ip_info(self, proxy: str) -> Optional[Dict[str, str]]:
+        """Cached identity of the proxy, None if it needs to be checked"""
+        s = self.stats[proxy]
+        if s.ip_info is None or time.time() - s.checked_at > self.check_interval:
+            return None
+        return s.ip_info
+
+    def set_ip_info(self, proxy: str, ip_info: Dict[str, str]):
+        with self.lock:
+            s = self.stats[proxy]
+            if s.ip_info is not None and s.ip_info.get("ip") != ip_info.get("ip"):
+                logger.info(f"Proxy {proxy} changed IP: {s.ip_info} -> {ip_info}")
+            s.ip_info = ip_info
+            s.checked_at = time.time()
+
+    def report(self, proxy: str, ok: bool, latency: float):
+        with self.lock:
+            s = self.stats[proxy]
+            s.total_latency += latency
+            if ok:
+                s.successes += 1
+                s.consecutive_failures = 0
+            else:
+                s.failures += 1
+                s.consecutive_failures += 1
+            block = s.consecutive_failures >= self.max_failures
+            self.reports += 1
+            log_summary = self.reports % 100 == 0
+        if block:
+            self.block(proxy, f"{self.max_failures} consecutive failures")
+        if log_summary:
+            self.log_summary()
+
+    def block(self, proxy: str, reason: str):
+        with self.lock:
+            s = self.stats[proxy]
+            s.blocked_until = time.time() + self.cooldown
+            s.consecutive_failures = 0
+            s.ip_info = None
+        logger.warning(f"Proxy {proxy} blocked for {self.cooldown}s: {reason}")
+
+    def summary(self) -> List[Dict]:
+        now = time.time()
+        with self.lock:
+            return [
+                {
+                    "proxy": p,
+                    "ip": (s.ip_info or {}).get("ip"),
+                    "successes": s.successes,
+                    "failures": s.failures,
+                    "success_rate": s.success_rate,
+                    "mean_latency_s": s.mean_latency,
+                    "blocked_s": max(0.0, s.blocked_until - now),
+                }
+                for p, s in self.stats.items()
+            ]
+
+    def log_summary(self):
+        import tabulate
+
+        table = tabulate.tabulate(self.summary(), headers="keys", floatfmt=".2f")
+        logger.info(f"Proxy pool:\n{table}")
+
+
+class LocalProxy(object):
+    """Minimal forward proxy for testing, supports plain http and CONNECT tunnels
+
+    After `block_after` requests it answers every request with `429 Too Many Requests`,
+    to simulate a proxy that is blocked by the search engines.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, block_after: Optional[int] = None):
+        proxy = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_CONNECT(self):
+                if proxy.blocked():
+                    return self.send_error(429)
+                host, _, port = self.path.rpartition(":")
+                try:
+                    upstream = socket.create_connection((host, int(port)), timeout=10)
+                except OSError as e:
+                    return self.send_error(502, str(e))
+                self.send_response(200, "Connection established")
+                self.end_headers()
+                proxy.tunnel(self.connection, upstream)
+
+            def do_GET(self):
+                if proxy.blocked():
+                    return self.send_error(429)
+                url = urllib.parse.urlsplit(self.path)
+                try:
+                    upstream = socket.create_connection(
+                        (url.hostname, url.port or 80), timeout=10
+                    )
+                except OSError as e:
+                    return self.send_error(502, str(e))
+                path = url.path + (f"?{url.query}" if url.query else "")
+                headers = "".join(
+                    f"{k}: {v}\r\n"
+                    for k, v in self.headers.items()
+                    if k.lower() not in ("proxy-connection", "connection")
+                )
+                upstream.sendall(
+                    f"GET {path or '/'} HTTP/1.1\r\n{headers}Connection: close\r\n\r\n".encode()
+                )
+                self.close_connection = True
+                proxy.tunnel(self.connection, upstream)
+
+            def log_message(self, format, *args):
+                logger.trace(format % args)
+
+        self.block_after = block_after
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def blocked(self) -> bool:
+        with self.lock:
+            self.requests += 1
+            return self.block_after is not None and self.requests > self.block_after
+
+    @staticmethod
+    def tunnel(client: socket.socket, upstream: socket.socket):
+        sockets = [client, upstream]
+        try:
+            while True:
+                readable, _, errored = select.select(sockets, [], sockets, 60)
+                if errored or not readable:
+                    break
+                for s in readable:
+                    data = s.recv(65536)
+                    if not data:
+                        return
+                    (upstream if s is client else client).sendall(data)
+        finally:
+            upstream.close()
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def check_proxy(proxy: str) -> Dict:
+    """IP info and latency of a proxy, using ip-api like `webly.scraper.get_ip_info`"""
+    import requests
+
+    start = time.perf_counter()
+    response = requests.get(
+        "http://ip-api.com/json/?fields=57625",
+        proxies={"http": proxy, "https": proxy},
+        timeout=10,
+    )
+    response.raise_for_status()
+    info = response.json()
+    return {"proxy": proxy, "latency_s": time.perf_counter() - start, **info}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Egress proxies")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="run a local stand-in proxy")
+    serve.add_argument("--host", type=str, default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8899)
+    serve.add_argument(
+        "--block-after",
+        type=int,
+        help="answer 429 to all requests after this many requests",
+        default=None,
+    )
+
+    check = commands.add_parser("check", help="print IP info and latency of proxies")
+    check.add_argument("proxies", nargs="+")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.command == "serve":
+        with LocalProxy(args.host, args.port, args.block_after) as proxy:
+            logger.info(f"Proxy listening on {proxy.url}")
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                logger.info("Interrupted: stop proxy")
+    elif args.command == "check":
+        import tabulate
+
+        rows = []
+        for proxy in args.proxies:
+            try:
+                rows.append(check_proxy(proxy))
+            except Exception as e:
+                rows.append({"proxy": proxy, "error": str(e)})
+        print(tabulate.tabulate(rows, headers="keys", floatfmt=".2f"))
+
+
+"""
+python -m webly.proxies serve --port 8899
+python -m webly.proxies check http://localhost:8899
+
+python -m webly.scraper \
+    --engines google yahoo flickr \
+    --chrome-binary /usr/bin/chromium \
+    --proxies http://localhost:8899 http://localhost:8900 \
+    --input text \
+    --output text
+"""
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import time
 from pathlib import Path
 from typing import Optional, Union
 
@@ -40,3 +41,94 @@ def declare_scrape_queue(channel):
         routing_key="scrape",
     )
     return "scrape"
+
+
+def queue_depth(channel, queue: str) -> int:
+    """Messages ready in a queue, from a passive declare that never creates it"""
+    return channel.queue_declare(queue=queue, passive=True).method.message_count
+
+
+class Backpressure(object):
+    """Pause a producer while the queue it publishes to is too deep
+
+    The depth is checked before the first message, then every `check_every` messages.
+    At `high` messages or more, the producer waits until the consumers have brought the
+    queue down to `low`, so the broker never holds much more than `high + check_every`.
+    """
+
+    def __init__(
+        self,
+        channel,
+        queue: str,
+        high: int,
+        low: Optional[int] = None,
+        check_every: int = 100,
+        poll_seconds: float = 5,
+    ):
+        self.channel = channel
+        self.queue = queue
+        self.high = high
+        self.low = low if low is not None else high // 2
+        if self.low > self.high:
+            raise ValueError(f"Low watermark {self.low} above high watermark {high}")
+        self.check_every = check_every
+        self.poll_seconds = poll_seconds
+        self.published = 0
+
+    def wait(self):
+        """Call before publishing a message"""
+        self.published += 1
+        if (self.published - 1) % self.check_every != 0:
+            return
+        self.pause()
+
+    def pause(self):
+        """Check the depth now, and wait for the consumers if it is at `high`"""
+        depth = queue_depth(self.channel, self.queue)
+        if depth < self.high:
+            return
+        logger.info(f"Queue `{self.queue}` has {depth} messages, pausing")
+        start = time.monotonic()
+        while depth > self.low:
+            # Sleep through the connection to keep serving heartbeats
+            self.channel.connection.sleep(self.poll_seconds)
+            depth = queue_depth(self.channel, self.queue)
+        logger.info(
+            f"Queue `{self.queue}` has {depth} messages, "
+            f"resuming after {time.monotonic() - start:.0f}s"
+        )
+
+
+def add_backpressure_arguments(parser):
+    backpressure = parser.add_argument_group("Backpressure options")
+    backpressure.add_argument(
+        "--high-watermark",
+        type=int,
+        help="pause publishing when the downstream queue holds this many messages, 0 to disable",
+        default=10000,
+    )
+    backpressure.add_argument(
+        "--low-watermark",
+        type=int,
+        help="resume publishing when the downstream queue is down to this many messages, "
+        "defaults to half the high watermark",
+        default=None,
+    )
+    backpressure.add_argument(
+        "--depth-check-every",
+        type=int,
+        help="check the downstream queue depth every this many messages",
+        default=100,
+    )
+
+
+def setup_backpressure(channel, queue: str, args) -> Optional[Backpressure]:
+    if args.high_watermark <= 0:
+        return None
+    return Backpressure(
+        channel,
+        queue,
+        args.high_watermark,
+        args.low_watermark,
+        check_every=args.depth_check_every,
+    )
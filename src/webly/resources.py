@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import json
+import threading
+import weakref
+from collections import defaultdict
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+from loguru import logger
+
+# Url patterns for `Network.setBlockedURLs`, `*` matches any sequence of characters
+RESOURCE_PATTERNS = {
+    "images": [
+        f"*.{ext}{q}"
+        for ext in ("jpg", "jpeg", "png", "gif", "webp", "avif", "svg", "ico")
+        for q in ("", "?*")
+    ],
+    "fonts": [
+        f"*.{ext}{q}" for ext in ("woff", "woff2", "ttf", "otf", "eot") for q in ("", "?*")
+    ],
+    "media": [
+        f"*.{ext}{q}" for ext in ("mp4", "webm", "m3u8", "mp3", "ogg") for q in ("", "?*")
+    ],
+    "stylesheets": ["*.css", "*.css?*"],
+    "trackers": [
+        "*google-analytics.com*",
+        "*googletagmanager.com*",
+        "*doubleclick.net*",
+        "*googlesyndication.com*",
+        "*googleadservices.com*",
+        "*scorecardresearch.com*",
+        "*analytics.yahoo.com*",
+        "*ads.yahoo.com*",
+        "*yimg.com/rq/darla*",
+        "*facebook.net*",
+        "*criteo.com*",
+        "*quantserve.com*",
+    ],
+}
+
+# What each engine can do without: the engine functions only read DOM attributes.
+# Google sets the http `src` of the preview image only once it is loaded, so images are kept.
+DEFAULT_POLICIES = {
+    "google": ["fonts", "media", "trackers"],
+    "yahoo": ["images", "fonts", "media", "trackers"],
+    "flickr": ["images", "fonts", "media", "trackers"],
+}
+
+# Resource Timing reports a `transferSize` of 0 for cross-origin resources without
+# `Timing-Allow-Origin`, so bytes and resources come from the network log if available
+PAGE_METRICS_SCRIPT = """
+const nav = performance.getEntriesByType('navigation')[0];
+const resources = performance.getEntriesByType('resource');
+return {
+    transfer_bytes: (nav ? nav.transferSize : 0)
+        + resources.reduce((sum, r) => sum + (r.transferSize || 0), 0),
+    resources: resources.length,
+    load_ms: nav && nav.loadEventEnd > 0 ? nav.loadEventEnd - nav.startTime : null,
+    elapsed_ms: performance.now(),
+};
+"""
+
+
+def execute_cdp(driver, cmd: str, params: Dict) -> Dict:
+    """Run a DevTools command on a local or remote Chrome driver"""
+    if hasattr(driver, "execute_cdp_cmd"):
+        return driver.execute_cdp_cmd(cmd, params)
+    driver.command_executor._commands["executeCdpCommand"] = (
+        "POST",
+        "/session/$sessionId/goog/cdp/execute",
+    )
+    return driver.execute("executeCdpCommand", {"cmd": cmd, "params": params})["value"]
+
+
+def enable_network_log(chrome_options):
+    """Record network events in the performance log, see `network_transfers`"""
+    chrome_options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    chrome_options.add_experimental_option(
+        "perfLoggingPrefs", {"enableNetwork": True, "enablePage": False}
+    )
+
+
+def network_transfers(driver) -> Tuple[int, int]:
+    """Encoded bytes and number of responses received since the last call
+
+    Reads and clears the performance log. The `encodedDataLength` of each
+    `Network.loadingFinished` counts the bytes on the wire, cross-origin or not.
+    """
+    transfer_bytes = resources = 0
+    for entry in driver.get_log("performance"):
+        if "Network.loadingFinished" not in entry["message"]:
+            continue
+        msg = json.loads(entry["message"])["message"]
+        if msg["method"] == "Network.loadingFinished":
+            transfer_bytes += msg["params"].get("encodedDataLength", 0)
+            resources += 1
+    return int(transfer_bytes), resources
+
+
+class ResourcePolicy(object):
+    """Block resource categories per engine and measure what each page transfers
+
+    Blocking uses DevTools request interception. If DevTools commands are unavailable,
+    e.g. behind some remote WebDriver endpoints, only images can be blocked and only
+    through Chrome preferences, if every selected engine blocks them.
+    """
+
+    def __init__(self, blocked: Mapping[str, Sequence[str]]):
+        for engine, categories in blocked.items():
+            for c in categories:
+                if c not in RESOURCE_PATTERNS:
+                    raise ValueError(f"Invalid resource category for {engine}: {c}")
+        self.blocked = {e: list(c) for e, c in blocked.items()}
+        self.cdp_available = True
+        self.network_log = True
+        self.drivers = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.pages: Dict[str, List[Dict]] = defaultdict(list)
+        for engine, categories in self.blocked.items():
+            if len(categories) > 0:
+                logger.info(f"Blocking resources for {engine}: {categories}")
+
+    @classmethod
+    def from_args(cls, policy: str, overrides: Optional[Sequence[str]]) -> ResourcePolicy:
+        """Policy `off` or `default`, overridden by `engine=category,category` strings"""
+        if policy == "off":
+            blocked = {}
+        elif policy == "default":
+            blocked = dict(DEFAULT_POLICIES)
+        else:
+            raise ValueError(f"Invalid resource policy: {policy}")
+        for override in overrides or []:
+            engine, _, categories = override.partition("=")
+            blocked[engine] = [c for c in categories.split(",") if c]
+        return cls(blocked)
+
+    def chrome_prefs(self, engines: Sequence[str]) -> Dict:
+        """Preferences for drivers that serve all `engines`, used without DevTools"""
+        if all("images" in self.blocked.get(e, []) for e in engines):
+            return {"profile.managed_default_content_settings.images": 2}
+        return {}
+
+    def apply(self, driver, engine: str):
+        """Set the blocked urls for the next pages loaded by the driver"""
+        if not self.cdp_available:
+            return
+        patterns = [p for c in self.blocked.get(engine, []) for p in RESOURCE_PATTERNS[c]]
+        with self.lock:
+            new_driver = driver not in self.drivers
+            self.drivers.add(driver)
+        try:
+            if new_driver:
+                execute_cdp(driver, "Network.enable", {})
+                # Keep more than the default 250 resource timings for `measure`
+                execute_cdp(
+                    driver,
+                    "Page.addScriptToEvaluateOnNewDocument",
+                    {"source": "performance.setResourceTimingBufferSize(100000);"},
+                )
+            execute_cdp(driver, "Network.setBlockedURLs", {"urls": patterns})
+        except Exception as e:
+            logger.warning(f"DevTools unavailable, resources will not be blocked: {e}")
+            self.cdp_available = False
+        # Only measure the pages of this engine
+        self._network_transfers(driver)
+
+    def measure(self, driver, engine: str) -> Dict:
+        """Transfer size and time of the current page, recorded for `summary`"""
+        metrics = driver.execute_script(PAGE_METRICS_SCRIPT)
+        network = self._network_transfers(driver)
+        if network is not None:
+            metrics["transfer_bytes"], metrics["resources"] = network
+        logger.debug(
+            f"Page {engine}: {metrics['transfer_bytes'] / 1024:.0f} KiB "
+            f"in {metrics['resources']} resources, "
+            f"load {metrics['load_ms'] or float('nan'):.0f} ms, "
+            f"elapsed {metrics['elapsed_ms']:.0f} ms"
+        )
+        with self.lock:
+            self.pages[engine].append(metrics)
+        return metrics
+
+    def _network_transfers(self, driver) -> Optional[Tuple[int, int]]:
+        if not self.network_log:
+            return None
+        try:
+            return network_transfers(driver)
+        except Exception as e:
+            logger.warning(f"Network log unavailable, using Resource Timing: {e}")
+            self.network_log = False
+            return None
+
+    def summary(self) -> List[Dict]:
+        with self.lock:
+            pages = {e: list(p) for e, p in self.pages.items()}
+        rows = []
+        for engine, metrics in pages.items():
+            loads = [m["load_ms"] for m in metrics if m["load_ms"] is not None]
+            rows.append(
+                {
+                    "engine": engine,
+                    "blocked": ",".join(self.blocked.get(engine, [])) or "-",
+                    "pages": len(metrics),
+                    "mean_KiB": sum(m["transfer_bytes"] for m in metrics)
+                    / len(metrics)
+                    / 1024,
+                    "mean_resources": sum(m["resources"] for m in metrics) / len(metrics),
+                    "mean_load_ms": sum(loads) / len(loads) if loads else float("nan"),
+                    "mean_elapsed_ms": sum(m["elapsed_ms"] for m in metrics)
+                    / len(metrics),
+                }
+            )
+        return rows
+
+    def log_summary(self):
+        import tabulate
+
+        rows = self.summary()
+        if len(rows) > 0:
+            table = tabulate.tabulate(rows, headers="keys", floatfmt=".1f")
+            logger.info(f"Page transfers:\n{table}")
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import socket
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Tuple
+
+from loguru import logger
+
+from .mongo import setup_mongo
+
+# Fields of a flat record that identify its query document within a run
+QUERY_KEY = ("predicate", "expansion", "engine", "query")
+
+# Fields of a flat record that differ between the results of one query document
+RESULT_FIELDS = (
+    "_id",
+    "result_index",
+    "caption",
+    "url",
+    "blob",
+    "canonical_url",
+    "duplicate",
+    "duplicate_of",
+)
+
+# Fields of a query document that are not copied into the flat records
+QUERY_INTERNAL = ("_id", "run", "ip", "num_results", "results", "download")
+
+
+class NormalizedOutput(object):
+    """Flat records written as one document per query in `webly.queries`
+
+    A query document is identified by the `QUERY_KEY` fields of its records, so the
+    same query scraped for two predicates or expansions gets two documents. The IP
+    infos and the configuration of the run are stored once in `webly.runs`, each result
+    keeps the `ip` it was scraped from. Records are buffered per query document and
+    pushed to its results array with a single upsert. Up to `max_keys` documents are
+    buffered at once, the one that received no record for the longest time is flushed
+    first, so records of concurrent scrapes are still batched when they arrive
+    interleaved.
+    """
+
+    def __init__(
+        self, db, config: Optional[Mapping[str, Any]] = None, max_keys: int = 1
+    ):
+        from bson import ObjectId
+
+        self.runs = db["runs"]
+        self.queries = db["queries"]
+        # Documents used to be keyed by (engine, query) only
+        if "run_1_engine_1_query_1" in self.queries.index_information():
+            self.queries.drop_index("run_1_engine_1_query_1")
+        self.queries.create_index(
+            [("run", 1)] + [(k, 1) for k in QUERY_KEY], unique=True
+        )
+        self.queries.create_index("results.canonical_url")
+        self.run = ObjectId()
+        self.runs.insert_one(
+            {
+                "_id": self.run,
+                "started_utc": datetime.utcnow(),
+                "host": socket.gethostname(),
+                "pid": os.getpid(),
+                "config": dict(config or {}),
+                "ip_infos": [],
+            }
+        )
+        self.ips = set()
+        self.max_keys = max_keys
+        self.buffers: Dict[Tuple, List[Dict]] = {}
+        logger.info(f"Normalized output, run {self.run}")
+
+    def __call__(self, d: Mapping[str, Any]):
+        key = tuple(d.get(k) for k in QUERY_KEY)
+        # Reinserted at the end, so the first key is the least recently used
+        buffer = self.buffers.pop(key, None)
+        if buffer is None:
+            if len(self.buffers) >= self.max_keys:
+                self._flush(next(iter(self.buffers)))
+            buffer = []
+        buffer.append(d)
+        self.buffers[key] = buffer
+
+    def flush(self):
+        for key in list(self.buffers):
+            self._flush(key)
+
+    def _flush(self, key: Tuple):
+        buffer = self.buffers.pop(key)
+        first = buffer[0]
+        results = []
+        for d in buffer:
+            res = {k: d[k] for k in RESULT_FIELDS if k in d}
+            ip_info = d.get("public_ip") or {}
+            ip = ip_info.get("ip")
+            if ip is not None:
+                res["ip"] = ip
+                if ip not in self.ips:
+                    self.runs.update_one(
+                        {"_id": self.run}, {"$addToSet": {"ip_infos": ip_info}}
+                    )
+                    self.ips.add(ip)
+            results.append(res)
+        meta = {
+            k: v
+            for k, v in first.items()
+            if k not in RESULT_FIELDS and k not in QUERY_KEY and k != "public_ip"
+        }
+        # Fields missing from the records are left out instead of stored as null
+        query = {k: first[k] for k in QUERY_KEY if k in first}
+        self.queries.update_one(
+            {"run": self.run, **query},
+            {
+                "$setOnInsert": meta,
+                "$push": {"results": {"$each": results}},
+                "$inc": {"num_results": len(results)},
+            },
+            upsert=True,
+        )
+
+    def checkpoint(self, fn: Callable):
+        self.flush()
+        fn()
+
+    def close(self):
+        self.flush()
+        self.runs.update_one(
+            {"_id": self.run}, {"$set": {"finished_utc": datetime.utcnow()}}
+        )
+
+
+def flatten_query(
+    doc: Mapping[str, Any], ip_infos: Optional[Mapping[str, Dict]] = None
+) -> Iterator[Dict]:
+    """Flat records of a query document, as written by the `flat` schema
+
+    Older documents have one `ip` for all their results instead of one per result, and
+    results without an `_id` get one from the document.
+    """
+    meta = {k: v for k, v in doc.items() if k not in QUERY_INTERNAL}
+    for i, res in enumerate(doc["results"]):
+        res = dict(res)
+        public_ip = (ip_infos or {}).get(res.pop("ip", doc.get("ip")))
+        yield {"_id": f"{doc['_id']}-{i}", **meta, **res, "public_ip": public_ip}
+
+
+def iter_flat_records(db, filter: Mapping = None) -> Iterator[Dict]:
+    """Flat records of all query documents matching `filter`, for existing consumers"""
+    runs: Dict[Any, Dict[str, Dict]] = {}
+    for doc in db["queries"].find(filter or {}):
+        if doc["run"] not in runs:
+            run = db["runs"].find_one({"_id": doc["run"]}) or {}
+            runs[doc["run"]] = {i["ip"]: i for i in run.get("ip_infos", [])}
+        yield from flatten_query(doc, runs[doc["run"]])
+
+
+def collection_sizes(db, names: List[str]) -> List[Dict]:
+    rows = []
+    existing = set(db.list_collection_names())
+    for name in names:
+        if name not in existing:
+            continue
+        s = db.command("collstats", name)
+        rows.append(
+            {
+                "collection": name,
+                "documents": s["count"],
+                "size_MiB": s["size"] / 2**20,
+                "storage_MiB": s["storageSize"] / 2**20,
+                "indexes_MiB": s["totalIndexSize"] / 2**20,
+            }
+        )
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Normalized storage schema")
+    parser.add_argument(
+        "--mongo-url", type=str, help="url for database connections", required=True
+    )
+    parser.add_argument(
+        "--mongo-pass-file",
+        type=str,
+        help="password file for database connections",
+        default=None,
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    flatten = commands.add_parser(
+        "flatten", help="print the flat records of the query documents as json lines"
+    )
+    flatten.add_argument("--run", type=str, help="only this run id", default=None)
+
+    commands.add_parser("sizes", help="compare the size of flat and normalized data")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    db = setup_mongo(args.mongo_url, args.mongo_pass_file).database
+
+    if args.command == "flatten":
+        from bson import ObjectId
+
+        filter = {"run": ObjectId(args.run)} if args.run is not None else {}
+        for d in iter_flat_records(db, filter):
+            d["datetime_utc"] = str(d["datetime_utc"])
+            print(json.dumps(d))
+    elif args.command == "sizes":
+        import tabulate
+
+        rows = collection_sizes(db, ["metadata", "runs", "queries"])
+        print(tabulate.tabulate(rows, headers="keys", floatfmt=".2f"))
+
+
+"""
+python -m webly.schema \
+    --mongo-url mongodb://user@localhost \
+    --mongo-pass-file .secrets/mongo_initdb_root_password \
+    flatten > results.jsonl
+"""
+if __name__ == "__main__":
+    main()
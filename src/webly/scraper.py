@@ -6,11 +6,11 @@ import sys
 import time
 import urllib.parse
 from datetime import datetime
-from itertools import islice
+from functools import partial
 from pathlib import Path
-from typing import Dict, Iterator
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
 
-from contextlib import ExitStack, suppress
+from contextlib import ExitStack, contextmanager, suppress
 import re
 
 from loguru import logger
@@ -18,7 +18,16 @@ from selenium import webdriver
 
 from webly.mongo import setup_mongo
 
+from .blobs import offload_inline_image, setup_blob_store
+from .journal import Journal, iter_lines
+from .proxies import ProxyPool
 from .rabbit import declare_scrape_queue, setup_rabbitmq
+from .resources import RESOURCE_PATTERNS, ResourcePolicy, enable_network_log
+from .schema import NormalizedOutput
+from .sinks import ColumnarFileSink, NdjsonFileSink
+from .stats import ScrapeStats
+from .tracing import Tracer, TracingDriver, set_tags, sleep
+from .urls import MemorySeenUrls, MongoSeenUrls, mark_duplicate
 
 
 def parse_args():
@@ -28,7 +37,29 @@ def parse_args():
     inputs.add_argument(
         "--input",
         choices=["text", "json", "amqp"],
-        default="text",
+        help="defaults to text, or to amqp with --workers",
+        default=None,
+    )
+    inputs.add_argument(
+        "--input-file",
+        type=str,
+        help="read text or json queries from this file instead of stdin",
+        default=None,
+    )
+    inputs.add_argument(
+        "--input-range",
+        type=int,
+        nargs=2,
+        metavar=("START", "END"),
+        help="only read lines starting in this byte range of --input-file, "
+        "see `python -m webly.journal ranges`",
+        default=None,
+    )
+    inputs.add_argument(
+        "--journal",
+        type=str,
+        help="record finished (query, engine) pairs in this file and skip them on restart",
+        default=None,
     )
     inputs.add_argument(
         "--amqp-url",
@@ -43,12 +74,81 @@ def parse_args():
         default=None,
     )
 
+    add_output_arguments(parser)
+    add_scraping_arguments(parser)
+
+    workers = parser.add_argument_group("Worker options")
+    workers.add_argument(
+        "--workers",
+        type=int,
+        help="run this many worker processes under a supervisor that restarts them",
+        default=None,
+    )
+    workers.add_argument(
+        "--restart-backoff",
+        type=float,
+        help="seconds before restarting a crashed worker, doubled on each crash",
+        default=5,
+    )
+    workers.add_argument(
+        "--drain-timeout",
+        type=float,
+        help="seconds to wait for workers to finish their current query on SIGTERM",
+        default=300,
+    )
+    workers.add_argument(
+        "--stats-interval",
+        type=float,
+        help="seconds between throughput reports",
+        default=60,
+    )
+
+    return parser.parse_args()
+
+
+def add_output_arguments(parser):
     output = parser.add_argument_group("Output options")
     output.add_argument(
         "--output",
-        choices=["text", "json", "mongo"],
+        choices=["text", "json", "mongo", "ndjson", "parquet", "arrow"],
         default="json",
     )
+    output.add_argument(
+        "--output-dir",
+        type=str,
+        help="directory for ndjson, parquet and arrow output files",
+        default=None,
+    )
+    output.add_argument(
+        "--output-prefix",
+        type=str,
+        help="file name prefix for output files",
+        default="results",
+    )
+    output.add_argument(
+        "--compression",
+        choices=["none", "gzip", "zstd"],
+        help="compression of ndjson output files",
+        default="gzip",
+    )
+    output.add_argument(
+        "--batch-size",
+        type=int,
+        help="records buffered in memory before writing to output files",
+        default=1000,
+    )
+    output.add_argument(
+        "--rotate-mb",
+        type=float,
+        help="start a new output file after this many MB on disk",
+        default=None,
+    )
+    output.add_argument(
+        "--rotate-minutes",
+        type=float,
+        help="start a new output file after this many minutes",
+        default=None,
+    )
     output.add_argument(
         "--mongo-url",
         type=str,
@@ -61,7 +161,34 @@ def parse_args():
         help="password file for database connections",
         default=None,
     )
+    output.add_argument(
+        "--schema",
+        choices=["flat", "normalized"],
+        help="mongo documents per result, or per (engine, query) with a run document",
+        default="flat",
+    )
+    output.add_argument(
+        "--blob-store",
+        choices=["none", "local", "gridfs"],
+        help="store inline data: images as content-addressed blobs and keep only a reference",
+        default="none",
+    )
+    output.add_argument(
+        "--blob-dir",
+        type=str,
+        help="directory for --blob-store local",
+        default=None,
+    )
+    output.add_argument(
+        "--seen-urls",
+        choices=["off", "memory", "mongo"],
+        help="index of canonical urls, repeats are written as references without url; "
+        "defaults to mongo for mongo output, off otherwise",
+        default=None,
+    )
+
 
+def add_scraping_arguments(parser):
     scraping = parser.add_argument_group("Scraping options")
     scraping.add_argument(
         "--engines",
@@ -76,6 +203,12 @@ def parse_args():
         help="max number of images per query",
         default=20,
     )
+    scraping.add_argument(
+        "--query-seconds",
+        type=float,
+        help="time budget per query and engine, scraping stops after it",
+        default=120,
+    )
 
     chrome = parser.add_argument_group("Chrome options")
     chrome.add_argument(
@@ -96,34 +229,113 @@ def parse_args():
     chrome.add_argument(
         "--chrome-driver", type=str, help="Only needed for local Chrome", default=None
     )
-
-    return parser.parse_args()
+    chrome.add_argument(
+        "--proxies",
+        type=str,
+        nargs="+",
+        help="egress proxies, e.g. http://host:port, each driver uses one of them",
+        default=None,
+    )
+    chrome.add_argument(
+        "--proxy-file",
+        type=str,
+        help="file with one egress proxy per line, alternative to --proxies",
+        default=None,
+    )
+    chrome.add_argument(
+        "--proxy-max-failures",
+        type=int,
+        help="block a proxy after this many consecutive failures",
+        default=3,
+    )
+    chrome.add_argument(
+        "--proxy-cooldown",
+        type=float,
+        help="seconds before a blocked proxy is used again",
+        default=600,
+    )
+    chrome.add_argument(
+        "--proxy-check-interval",
+        type=float,
+        help="seconds before the IP info of a proxy is checked again",
+        default=3600,
+    )
+    chrome.add_argument(
+        "--resource-policy",
+        choices=["off", "default"],
+        help="block page resources that the engines do not need, e.g. fonts and trackers",
+        default="default",
+    )
+    chrome.add_argument(
+        "--block-resources",
+        type=str,
+        nargs="+",
+        metavar="ENGINE=CATEGORIES",
+        help="override the blocked resources of an engine, e.g. google=fonts,media "
+        f"(categories: {','.join(RESOURCE_PATTERNS)})",
+        default=None,
+    )
+    chrome.add_argument(
+        "--trace-file",
+        type=str,
+        help="Record a timed span for every WebDriver command to this jsonl file",
+        default=None,
+    )
 
 
-def stdin_input_iterator():
-    logger.info("Reading queries from stdin")
-    for line in sys.stdin:
+def stdin_input_iterator(lines=None):
+    if lines is None:
+        logger.info("Reading queries from stdin")
+        lines = sys.stdin
+    for line in lines:
         yield {"query": line.strip()}
 
 
-def json_input_iterator():
-    logger.info("Reading json queries from stdin")
-    for line in sys.stdin:
+def json_input_iterator(lines=None):
+    if lines is None:
+        logger.info("Reading json queries from stdin")
+        lines = sys.stdin
+    for line in lines:
         yield json.loads(line)
 
 
-def rabbit_input_iterator(channel):
+def file_lines(input_file, input_range=None):
+    start, end = input_range if input_range is not None else (0, None)
+    logger.info(f"Reading lines from {input_file} [{start}, {end})")
+    return iter_lines(input_file, start, end)
+
+
+def rabbit_input_iterator(channel, stop=None):
+    """Consume queries until interrupted or until the `stop` event is set
+
+    When stopping, the current message is acked once processed and messages that were
+    prefetched but not yet processed are requeued. The caller keeps iterating until the
+    iterator ends, breaking out of the loop would leave the current message unacked.
+    """
     queue = declare_scrape_queue(channel)
     logger.info(f"Receiving queries from queue `{queue}`")
 
     try:
-        for method, properties, body in channel.consume(queue=queue, auto_ack=False):
+        for method, properties, body in channel.consume(
+            queue=queue, auto_ack=False, inactivity_timeout=1
+        ):
+            if stop is not None and stop.is_set():
+                if method is not None:
+                    channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                logger.info("Stopping: stop receiving messages")
+                break
+            if method is None:
+                continue
             try:
                 yield json.loads(body)
                 channel.basic_ack(delivery_tag=method.delivery_tag)
             except Exception as e:
                 logger.exception("Error while processing msg", e)
                 channel.basic_nack(delivery_tag=method.delivery_tag)
+            # Checked after the ack, the caller must not stop iterating by itself
+            if stop is not None and stop.is_set():
+                logger.info("Stopping: stop receiving messages")
+                break
     except KeyboardInterrupt:
         logger.info("Interrupted: stop receiving messages")
     except Exception as e:
@@ -133,12 +345,18 @@ def rabbit_input_iterator(channel):
 
 
 def stdout_output(d):
+    if "url" not in d:
+        url = f'duplicate of {d["canonical_url"]}'
+    elif d["url"].startswith("data:image/"):
+        url = d["url"][:20]
+    else:
+        url = d["url"]
     print(
         d["engine"],
         d["query"],
         d["result_index"],
         d["caption"],
-        d["url"][:20] if d["url"].startswith("data:image/") else d["url"],
+        url,
         sep="\t",
     )
 
@@ -148,64 +366,268 @@ def json_output(d):
     print(json.dumps(d))
 
 
+def file_sink(args):
+    if args.output_dir is None:
+        raise ValueError(f"--output {args.output} requires --output-dir")
+    kwargs = {
+        "prefix": args.output_prefix,
+        "batch_size": args.batch_size,
+        "rotate_bytes": int(args.rotate_mb * 2 ** 20) if args.rotate_mb else None,
+        "rotate_seconds": 60 * args.rotate_minutes if args.rotate_minutes else None,
+    }
+    if args.output == "ndjson":
+        return NdjsonFileSink(args.output_dir, compression=args.compression, **kwargs)
+    return ColumnarFileSink(args.output_dir, format=args.output, **kwargs)
+
+
+def checkpoint(output, fn):
+    """Call `fn` once everything passed to `output` so far has been written"""
+    if hasattr(output, "checkpoint"):
+        output.checkpoint(fn)
+    else:
+        sys.stdout.flush()
+        fn()
+
+
 def chrome_helper(
-    chrome_url=None, chrome_token_file=None, chrome_binary=None, chrome_driver=None
+    chrome_url=None,
+    chrome_token_file=None,
+    chrome_binary=None,
+    chrome_driver=None,
+    tracer: Tracer = None,
+    prefs: Dict = None,
 ):
+    """Driver factory, the driver can be created with an egress proxy e.g. `http://host:port`"""
     if chrome_url is None:
         logger.debug(f"Using local Chrome")
-        chrome_options = webdriver.ChromeOptions()
-        chrome_options.headless = False
-        if chrome_binary is not None:
-            chrome_options.binary_location = chrome_binary
         kwargs = {}
         if chrome_driver is not None:
             kwargs["executable_path"] = chrome_driver
 
-        def create_driver():
+        def create_driver(proxy=None):
+            chrome_options = webdriver.ChromeOptions()
+            chrome_options.headless = False
+            if chrome_binary is not None:
+                chrome_options.binary_location = chrome_binary
+            if proxy is not None:
+                chrome_options.add_argument(f"--proxy-server={proxy}")
+            if prefs:
+                chrome_options.add_experimental_option("prefs", prefs)
+            enable_network_log(chrome_options)
             return webdriver.Chrome(options=chrome_options, **kwargs)
 
     else:
         logger.debug(f"Using remote Chrome ({chrome_url})")
-        chrome_options = webdriver.ChromeOptions()
-        chrome_options.add_argument("--headless")
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--disable-dev-shm-usage")
         token = Path(chrome_token_file).read_text().strip().replace("TOKEN=", "", 1)
-        chrome_options.set_capability("browserless.token", token)
-        capabilities = chrome_options.to_capabilities()
 
-        def create_driver():
+        def create_driver(proxy=None):
+            chrome_options = webdriver.ChromeOptions()
+            chrome_options.add_argument("--headless")
+            chrome_options.add_argument("--no-sandbox")
+            chrome_options.add_argument("--disable-dev-shm-usage")
+            if proxy is not None:
+                chrome_options.add_argument(f"--proxy-server={proxy}")
+            if prefs:
+                chrome_options.add_experimental_option("prefs", prefs)
+            enable_network_log(chrome_options)
+            chrome_options.set_capability("browserless.token", token)
             return webdriver.Remote(
                 command_executor=chrome_url,
-                desired_capabilities=capabilities,
+                desired_capabilities=chrome_options.to_capabilities(),
             )
 
+    if tracer is not None:
+        return lambda proxy=None: TracingDriver(create_driver(proxy), tracer)
     return create_driver
 
 
+class ChromeSetup(NamedTuple):
+    create_driver: Callable
+    ip_info: Optional[Dict[str, str]]
+    tracer: Optional[Tracer]
+    proxies: Optional[ProxyPool]
+    resources: ResourcePolicy
+
+    def close(self):
+        if self.tracer is not None:
+            self.tracer.close()
+        if self.proxies is not None:
+            self.proxies.log_summary()
+        self.resources.log_summary()
+
+
+@contextmanager
+def session(chrome: ChromeSetup):
+    """New driver with the IP info to tag its records, through a proxy of the pool if any
+
+    The identity and health of a proxy is checked with `get_ip_info` when a driver
+    starts, unless it was checked recently. Proxies that fail the check are blocked.
+    """
+    create_driver, proxies = chrome.create_driver, chrome.proxies
+    if proxies is None:
+        with create_driver() as driver:
+            yield driver, None, chrome.ip_info
+        return
+
+    for _ in range(len(proxies)):
+        proxy = proxies.acquire()
+        driver = create_driver(proxy)
+        proxy_ip_info = proxies.ip_info(proxy)
+        if proxy_ip_info is None:
+            start = time.perf_counter()
+            try:
+                proxy_ip_info = get_ip_info(driver)
+            except Exception as e:
+                driver.quit()
+                proxies.report(proxy, ok=False, latency=time.perf_counter() - start)
+                proxies.block(proxy, f"IP check failed: {e}")
+                continue
+            proxies.set_ip_info(proxy, proxy_ip_info)
+            logger.debug(f"Proxy {proxy} IP info: {proxy_ip_info}")
+        with driver:
+            yield driver, proxy, proxy_ip_info
+        return
+    raise RuntimeError("No healthy proxy available")
+
+
+def is_blocked(driver) -> bool:
+    """Heuristic detection of captcha, rate-limit and proxy error pages"""
+    if "/sorry/" in driver.current_url:
+        return True
+    title = driver.title.lower()
+    if any(w in title for w in ("captcha", "unusual traffic", "too many requests")):
+        return True
+    return len(driver.find_elements_by_css_selector("body.neterror")) > 0
+
+
+IP_INFO_URL = "http://ip-api.com/json/?fields=57625"
+
+
 def get_ip_info(driver) -> Dict[str, str]:
-    driver.get("http://ip-api.com/json/?fields=57625")
-    response = json.loads(driver.find_element_by_tag_name("pre").text)
+    driver.get(IP_INFO_URL)
+    return parse_ip_info(driver.find_element_by_tag_name("pre").text)
+
+
+def parse_ip_info(text: str) -> Dict[str, str]:
+    response = json.loads(text)
     if response.pop("status") != "success":
         raise RuntimeError(response["message"])
     response["ip"] = response.pop("query")
     return response
 
 
-def get_google_images(driver, query) -> Iterator[Dict]:
+class ScrollBudget(object):
+    """Target number of results and time budget of one engine query
+
+    Engines stop as soon as `exhausted`, and `reason` explains why they stopped:
+    `target` results were reached, the `seconds` were spent, the page had no more results
+    (`exhausted`), or an `error` occurred.
+    """
+
+    def __init__(self, target: Optional[int] = None, seconds: Optional[float] = None):
+        self.target = target
+        self.seconds = seconds
+        self.start = time.monotonic()
+        self.results = 0
+        self.scrolls = 0
+        self.reason: Optional[str] = None
+
+    def exhausted(self) -> bool:
+        if self.reason is None:
+            if self.target is not None and self.results >= self.target:
+                self.reason = "target"
+            elif (
+                self.seconds is not None
+                and time.monotonic() - self.start >= self.seconds
+            ):
+                self.reason = "budget"
+        return self.reason is not None
+
+    def stop(self, reason: str):
+        if self.reason is None:
+            self.reason = reason
+
+    def summary(self) -> Dict:
+        return {
+            "reason": self.reason,
+            "results": self.results,
+            "scrolls": self.scrolls,
+            "seconds": time.monotonic() - self.start,
+        }
+
+
+# Elements matching a css selector or an xpath, from the index `arguments[2]` on
+NEW_ELEMENTS_SCRIPT = """
+const [by, selector, start] = arguments;
+if (by === 'css selector') {
+    return Array.from(document.querySelectorAll(selector)).slice(start);
+}
+const nodes = document.evaluate(
+    selector, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+const elements = [];
+for (let i = start; i < nodes.snapshotLength; i++) {
+    elements.push(nodes.snapshotItem(i));
+}
+return elements;
+"""
+
+
+def new_elements(driver, by: str, selector: str, start: int) -> List:
+    return driver.execute_script(NEW_ELEMENTS_SCRIPT, by, selector, start) or []
+
+
+def iter_result_elements(
+    driver, by: str, selector: str, budget: ScrollBudget, patience: int = 1
+) -> Iterator[Tuple[int, object]]:
+    """Result elements with their index, scrolling only once all found ones are read
+
+    Each pass fetches only the elements added since the previous pass. Stops when the
+    budget is exhausted, or when `patience` + 1 passes in a row find no new element.
+    """
+    seen = 0
+    misses = 0
+    while not budget.exhausted():
+        elements = new_elements(driver, by, selector, seen)
+        if len(elements) > 0:
+            logger.trace(f"New results: {len(elements)}")
+            misses = 0
+            for i, element in enumerate(elements, start=seen):
+                if budget.exhausted():
+                    return
+                yield i, element
+            seen += len(elements)
+        else:
+            misses += 1
+            if misses > patience:
+                logger.debug(f"No more results after {seen}")
+                budget.stop("exhausted")
+                return
+        if budget.exhausted():
+            return
+        scroll_to_end(driver)
+        budget.scrolls += 1
+
+
+# Caption and full-size image in the preview pane of a clicked Google thumbnail
+GOOGLE_CAPTION_XPATH = (
+    '//*[@id="Sva75c"]/div/div/div[3]/div[2]/c-wiz/div/div[1]/div[3]/div[2]/a'
+)
+GOOGLE_IMAGE_XPATH = (
+    '//*[@id="Sva75c"]/div/div/div[3]/div[2]/c-wiz/div/div[1]/div[1]/div/div[2]/a/img'
+)
+
+
+def get_google_images(driver, query, budget: ScrollBudget = None) -> Iterator[Dict]:
     """Scrape image urls and captions from Google Images"""
+    budget = budget or ScrollBudget()
 
     def get_one(thumbnail):
         """Click on one thumbnail and try to get the http image source, fallback to url encoded"""
         driver.execute_script("arguments[0].click();", thumbnail)
-        time.sleep(0.5)
-
-        caption = driver.find_element_by_xpath(
-            '//*[@id="Sva75c"]/div/div/div[3]/div[2]/c-wiz/div/div[1]/div[3]/div[2]/a'
-        ).text
-        img_element = driver.find_element_by_xpath(
-            '//*[@id="Sva75c"]/div/div/div[3]/div[2]/c-wiz/div/div[1]/div[1]/div/div[2]/a/img'
-        )
+        sleep(driver, 0.5)
+
+        caption = driver.find_element_by_xpath(GOOGLE_CAPTION_XPATH).text
+        img_element = driver.find_element_by_xpath(GOOGLE_IMAGE_XPATH)
         url = img_element.get_attribute("src")
         return caption, url
 
@@ -221,33 +643,28 @@ def get_google_images(driver, query) -> Iterator[Dict]:
     driver.get("https://www.google.com/search?" + query_params)
     query_datetime = datetime.utcnow()
 
-    result_index = 0
-    while True:
-        scroll_to_end(driver)
-        thumbnails = driver.find_elements_by_css_selector("img.Q4LuWd")
-        thumbnails = thumbnails[result_index:]
-        if len(thumbnails) == 0:
-            logger.debug("No more images after scrolling")
-            return
-        logger.trace(f"New images after scrolling: {len(thumbnails)}")
+    for result_index, thumbnail in iter_result_elements(
+        driver, "css selector", "img.Q4LuWd", budget
+    ):
+        set_tags(driver, result_index=result_index)
+        with logger.catch(Exception, reraise=False):
+            caption, url = get_one(thumbnail)
+            if url.endswith(".gif"):
+                logger.debug(f"Result {result_index} is .gif, skipping")
+                continue
+            budget.results += 1
+            yield {
+                "query": query,
+                "datetime_utc": query_datetime,
+                "result_index": result_index,
+                "caption": caption,
+                "url": url,
+            }
 
-        for thumbnail in thumbnails:
-            with logger.catch(Exception, reraise=False):
-                caption, url = get_one(thumbnail)
-                if url.endswith(".gif"):
-                    logger.debug(f"Result {result_index} is .gif, skipping")
-                    continue
-                yield {
-                    "query": query,
-                    "datetime_utc": query_datetime,
-                    "result_index": result_index,
-                    "caption": caption,
-                    "url": url,
-                }
-            result_index += 1
 
-def get_yahoo_images(driver, query):
+def get_yahoo_images(driver, query, budget: ScrollBudget = None) -> Iterator[Dict]:
     """Scrape image urls and captions from Yahoo Images"""
+    budget = budget or ScrollBudget()
     query_params = urllib.parse.urlencode(
         {
             "safe": "off",
@@ -262,40 +679,28 @@ def get_yahoo_images(driver, query):
 
     # Accept cookie
     with suppress(Exception):
-        self.chrome.find_element_by_xpath(
+        driver.find_element_by_xpath(
             '//*[@id="consent-page"]/div/div/div/div[2]/div[2]/form/button'
         ).click()
 
-    prevLength = 0
-    result_index = 0
-    while True:
-        scroll_to_end(driver)
-
-        html_list = driver.find_element_by_xpath('//*[@id="sres"]')
-        items = html_list.find_elements_by_tag_name("li")
-
-        if len(items) == prevLength:
-            logger.debug("Loaded all images")
-            break
-        
-        logger.trace(f"New images after scrolling: {len(items)}")
-        
-        prevLength = len(items)
-
-        for content in items[result_index : len(items) - 1]:
+    for result_index, content in iter_result_elements(
+        driver, "css selector", "#sres li", budget
+    ):
+        set_tags(driver, result_index=result_index)
+        with logger.catch(Exception, reraise=False):
             try:
                 driver.execute_script("arguments[0].click();", content)
-                time.sleep(0.5)
-            except Exception as e:
-                new_html_list = driver.find_element_by_id("sres")
-                new_items = new_html_list.find_elements_by_tag_name("li")
-                item = new_items[i]
+                sleep(driver, 0.5)
+            except Exception:
+                # The list was re-rendered, click the same item of the new list
+                item = new_elements(driver, "css selector", "#sres li", result_index)[0]
                 driver.execute_script("arguments[0].click();", item)
             caption = driver.find_element_by_class_name("title").text
 
             url = driver.find_element_by_xpath('//*[@id="img"]')
             src = url.get_attribute("src")
             if src is not None and not src.endswith("gif"):
+                budget.results += 1
                 yield {
                     "query": query,
                     "datetime_utc": query_datetime,
@@ -303,10 +708,23 @@ def get_yahoo_images(driver, query):
                     "caption": caption,
                     "url": src,
                 }
-            result_index += 1
 
-def get_flickr_images(driver, query):
+
+def flickr_url(style: Optional[str]) -> Optional[str]:
+    """Image url from the background style of a Flickr result"""
+    url = re.search(r'url\("//(.+?)"\);', style or "")
+    return "http://" + url.group(1) if url else None
+
+
+def flickr_caption(title: str) -> str:
+    """Caption from the title of a Flickr result, without the author"""
+    by = re.search(r"\bby\b", title)
+    return title[: by.start()].strip() if by is not None else title
+
+
+def get_flickr_images(driver, query, budget: ScrollBudget = None) -> Iterator[Dict]:
     """Scrape image urls and captions from Flickr Images"""
+    budget = budget or ScrollBudget()
     query_params = urllib.parse.urlencode(
         {
             "safe": "off",
@@ -319,36 +737,25 @@ def get_flickr_images(driver, query):
     driver.get("https://www.flickr.com/search/?" + query_params)
     query_datetime = datetime.utcnow()
 
-    prevLength = 0
-    i = 0
-    result_index = 0
-    waited = False
-    while True:
-        scroll_to_end(driver)
-
-        items = driver.find_elements_by_xpath(
-            "/html/body/div[1]/div/main/div[2]/div/div[2]/div"
-        )
-
-        if len(items) == prevLength:
-            if not waited:
-                driver.implicitly_wait(25)
-                waited = True
-            else:
-                logger.debug("Loaded all images")
-                break
-        prevLength = len(items)
-
-        for item in items[result_index : len(items) - 1]:
-            style = item.get_attribute("style")
-            url = re.search(r'url\("//(.+?)"\);', style)
+    # Flickr loads more results slowly, give it one more scroll before giving up
+    for result_index, item in iter_result_elements(
+        driver,
+        "xpath",
+        "/html/body/div[1]/div/main/div[2]/div/div[2]/div",
+        budget,
+        patience=2,
+    ):
+        set_tags(driver, result_index=result_index)
+        with logger.catch(Exception, reraise=False):
+            url = flickr_url(item.get_attribute("style"))
             if url:
-                url = "http://" + url.group(1)
-                caption = item.find_element_by_class_name(
-                        "interaction-bar"
-                ).get_attribute("title")
-                caption = caption[: re.search(r"\bby\b", caption).start()].strip()
+                caption = flickr_caption(
+                    item.find_element_by_class_name("interaction-bar").get_attribute(
+                        "title"
+                    )
+                )
 
+                budget.results += 1
                 yield {
                     "query": query,
                     "datetime_utc": query_datetime,
@@ -356,24 +763,119 @@ def get_flickr_images(driver, query):
                     "caption": caption,
                     "url": url,
                 }
-            result_index += 1
+
+
+ENGINES = {
+    "google": get_google_images,
+    "yahoo": get_yahoo_images,
+    "flickr": get_flickr_images,
+}
 
 
 def scroll_to_end(driver):
     """Scroll to end of page"""
     driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-    time.sleep(1)
+    sleep(driver, 1)
 
 
-def main():
-    args = parse_args()
+# Arguments stored in the run document of the normalized schema
+RUN_CONFIG = (
+    "engines",
+    "num_images",
+    "resource_policy",
+    "block_resources",
+    "blob_store",
+    "seen_urls",
+    "input",
+)
+
+
+def setup_db(args):
+    """One `webly` database for outputs, stats, seen urls and blobs, None if unused"""
+    if args.output == "mongo" or args.seen_urls == "mongo" or args.blob_store == "gridfs":
+        return setup_mongo(args.mongo_url, args.mongo_pass_file).database
+    return None
 
+
+def setup_output(args, db=None, concurrency: int = 1):
+    """Output of the records, `concurrency` scrapes might interleave their records"""
+    if args.output == "text":
+        output = stdout_output
+    elif args.output == "json":
+        output = json_output
+    elif args.output == "mongo":
+        if args.schema == "normalized":
+            config = {k: getattr(args, k, None) for k in RUN_CONFIG}
+            output = NormalizedOutput(db, config, concurrency)
+        else:
+            # Finds the first result of a duplicate reference by its canonical url
+            db["metadata"].create_index("canonical_url")
+            output = db["metadata"].insert_one
+    elif args.output in ("ndjson", "parquet", "arrow"):
+        output = file_sink(args)
+    else:
+        raise ValueError(f"Invalid --output: {args.output}")
+    return output
+
+
+def setup_stats(args, db=None) -> Optional[ScrapeStats]:
+    """Summary counters next to the results, only for mongo output"""
+    if args.output != "mongo":
+        return None
+    return ScrapeStats(db)
+
+
+def setup_seen_urls(args, db=None):
+    kind = args.seen_urls
+    if kind is None:
+        kind = "mongo" if args.output == "mongo" else "off"
+    if kind == "off":
+        return None
+    elif kind == "memory":
+        return MemorySeenUrls()
+    elif kind == "mongo":
+        return MongoSeenUrls(db)
+    else:
+        raise ValueError(f"Invalid --seen-urls: {kind}")
+
+
+def driver_helper(args, ip_info=None) -> ChromeSetup:
+    """Driver factory, IP info, proxy pool and resource policy from the command line
+
+    Exit if Chrome is unusable. With a proxy pool, the IP info is checked per proxy instead.
+    The check is skipped if `ip_info` is given, e.g. by the supervisor of a worker.
+    """
+    tracer = Tracer(args.trace_file) if args.trace_file is not None else None
+    resources = ResourcePolicy.from_args(args.resource_policy, args.block_resources)
     create_driver = chrome_helper(
         args.chrome_url,
         args.chrome_token_file,
         args.chrome_binary,
         args.chrome_driver,
+        tracer,
+        resources.chrome_prefs(args.engines),
     )
+
+    proxy_kwargs = {
+        "max_failures": args.proxy_max_failures,
+        "cooldown": args.proxy_cooldown,
+        "check_interval": args.proxy_check_interval,
+    }
+    if args.proxies is not None:
+        proxies = ProxyPool(args.proxies, **proxy_kwargs)
+    elif args.proxy_file is not None:
+        proxies = ProxyPool.from_file(args.proxy_file, **proxy_kwargs)
+    else:
+        proxies = None
+    if proxies is not None or ip_info is not None:
+        return ChromeSetup(create_driver, ip_info, tracer, proxies, resources)
+
+    ip_info = startup_ip_info(create_driver)
+    return ChromeSetup(create_driver, ip_info, tracer, proxies, resources)
+
+
+def startup_ip_info(create_driver) -> Dict[str, str]:
+    """IP info of a fresh driver, exit if Chrome is unusable"""
     try:
         driver = create_driver()
         with driver:
@@ -382,39 +884,155 @@ def main():
     except Exception as e:
         logger.exception("Could not get IP info", e)
         exit(1)
+    return ip_info
+
+
+def scrape(
+    chrome: ChromeSetup,
+    driver,
+    proxy: Optional[str],
+    ip_info,
+    d,
+    engine: str,
+    num_images: int,
+    blob_store=None,
+    seen=None,
+    query_seconds: Optional[float] = None,
+    stats: Optional[ScrapeStats] = None,
+) -> Iterator[Dict]:
+    """Output records for one query and one engine from a `session`
+
+    Apply the resource policy of the engine, measure the page, and report the outcome
+    to the proxy pool. With a `seen` url index, repeated images become references.
+    The engine stops at `num_images` results or after `query_seconds`, the reason is
+    logged and counted in `stats`.
+    """
+    proxies = chrome.proxies
+    set_tags(driver, engine=engine, query=d["query"], result_index=None)
+    chrome.resources.apply(driver, engine)
+    start = time.perf_counter()
+    budget = ScrollBudget(num_images, query_seconds)
+    duplicates = 0
+    try:
+        for res in ENGINES[engine](driver, d["query"], budget):
+            record = {**d, **res, "engine": engine, "public_ip": ip_info}
+            if blob_store is not None:
+                record = offload_inline_image(record, blob_store)
+            if seen is not None:
+                record = mark_duplicate(record, seen)
+                duplicates += record["duplicate"]
+            yield record
+    except Exception:
+        budget.stop("error")
+        if proxies is not None:
+            proxies.report(proxy, ok=False, latency=time.perf_counter() - start)
+        raise
+    finally:
+        # Closed by the consumer before the engine stopped
+        budget.stop("closed")
+        summary = budget.summary()
+        logger.debug(f'Scraped {engine}: {d["query"]}, {summary}')
+        if stats is not None:
+            stats.record(
+                d,
+                engine,
+                budget.results,
+                {
+                    "duplicates": duplicates,
+                    "scrolls": budget.scrolls,
+                    f"stopped_{budget.reason}": 1,
+                },
+            )
+    if proxies is not None:
+        blocked = budget.results == 0 and is_blocked(driver)
+        proxies.report(proxy, ok=not blocked, latency=time.perf_counter() - start)
+        if blocked:
+            proxies.block(proxy, f"blocked by {engine}")
+    with logger.catch(Exception, reraise=False):
+        chrome.resources.measure(driver, engine)
+
+
+def main():
+    args = parse_args()
+    if args.input is None:
+        args.input = "amqp" if args.workers is not None else "text"
+
+    if args.workers is not None:
+        from .supervisor import supervise
+
+        supervise(args)
+    else:
+        run(args, driver_helper(args))
+
+
+def run(args, chrome: ChromeSetup, stop=None, progress: Callable[[int], None] = None):
+    """Scrape all inputs, until the `stop` event is set if any
+
+    `progress` is called with the number of records after each query.
+    """
+    lines = None
+    if args.input_file is not None:
+        lines = file_lines(args.input_file, args.input_range)
 
     if args.input == "text":
-        inputs = stdin_input_iterator()
+        inputs = stdin_input_iterator(lines)
     elif args.input == "json":
-        inputs = json_input_iterator()
+        inputs = json_input_iterator(lines)
     elif args.input == "amqp":
         channel = setup_rabbitmq(args.amqp_url, args.amqp_pass_file)
-        inputs = rabbit_input_iterator(channel)
+        inputs = rabbit_input_iterator(channel, stop)
     else:
         raise ValueError(f"Invalid --input: {args.input}")
 
-    if args.output == "text":
-        output = stdout_output
-    elif args.output == "json":
-        output = json_output
-    elif args.output == "mongo":
-        collection = setup_mongo(args.mongo_url, args.mongo_pass_file)
-        output = collection.insert_one
-    else:
-        raise ValueError(f"Invalid --output: {args.output}")
+    db = setup_db(args)
+    output = setup_output(args, db)
+    blob_store = setup_blob_store(args.blob_store, args.blob_dir, db)
 
-    for d in inputs:
-        driver = create_driver()
-        with driver:
-            for engine in args.engines:
-                scraping_fn = {
-                    "google": get_google_images,
-                    "yahoo": get_yahoo_images,
-                    "flickr": get_flickr_images,
-                }[engine]
-                for res in islice(scraping_fn(driver, d["query"]), args.num_images):
-                    output({**d, **res, "engine": engine, "public_ip": ip_info})
-                logger.debug(f'Scraped {engine}: {d["query"]}')
+    seen = setup_seen_urls(args, db)
+
+    journal = Journal(args.journal) if args.journal is not None else None
+    stats = setup_stats(args, db)
+
+    try:
+        for d in inputs:
+            engines = args.engines
+            if journal is not None:
+                engines = [e for e in engines if (d["query"], e) not in journal]
+                if len(engines) == 0:
+                    logger.debug(f'Already scraped: {d["query"]}')
+                    continue
+
+            records = 0
+            with session(chrome) as (driver, proxy, ip_info):
+                for engine in engines:
+                    for record in scrape(
+                        chrome,
+                        driver,
+                        proxy,
+                        ip_info,
+                        d,
+                        engine,
+                        args.num_images,
+                        blob_store,
+                        seen,
+                        query_seconds=args.query_seconds,
+                        stats=stats,
+                    ):
+                        output(record)
+                        records += 1
+                    if journal is not None:
+                        checkpoint(output, partial(journal.add, d["query"], engine))
+            if progress is not None:
+                progress(records)
+            # The amqp iterator stops by itself, after acking the current message
+            if stop is not None and stop.is_set() and args.input != "amqp":
+                logger.info("Stopping: stop reading inputs")
+                break
+    finally:
+        if hasattr(output, "close"):
+            output.close()
+
+    chrome.close()
 
 
 """
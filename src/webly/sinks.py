@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, List, Mapping, Optional, Union
+
+from loguru import logger
+
+
+class RotatingFileSink(object):
+    """Buffer records in memory and write them in batches to a sequence of files
+
+    Files are written as `<name>.part` and renamed when complete, i.e. when the sink
+    rotates after `rotate_bytes` bytes on disk or `rotate_seconds` seconds, or is closed.
+    """
+
+    suffix = ""
+
+    def __init__(
+        self,
+        output_dir: Union[str, Path],
+        prefix: str = "results",
+        batch_size: int = 1000,
+        rotate_bytes: Optional[int] = None,
+        rotate_seconds: Optional[float] = None,
+    ):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+
+        self.buffer: List[Mapping[str, Any]] = []
+        self.path: Optional[Path] = None
+        self.opened_at = 0.0
+        self.buffered_at = 0.0
+        self.file_idx = 0
+        self._on_flush: List[Callable] = []
+        self._on_close: List[Callable] = []
+
+    def __call__(self, d: Mapping[str, Any]):
+        if len(self.buffer) == 0:
+            self.buffered_at = time.time()
+        self.buffer.append(d)
+        if len(self.buffer) >= self.batch_size or self._expired():
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            if self.path is not None and not self._accepts(self.buffer):
+                # Checkpoints also wait for the buffered records, run them after those
+                pending, self._on_close = self._on_close, []
+                self._close_current()
+                self._on_close = pending
+            if self.path is None:
+                self._open_next()
+            self._write(self.buffer)
+            self.buffer = []
+        for fn in self._on_flush:
+            fn()
+        self._on_flush = []
+
+        if self.path is not None and (
+            (self.rotate_bytes is not None and self._size() >= self.rotate_bytes)
+            or self._expired()
+        ):
+            self._close_current()
+
+    def checkpoint(self, fn: Callable):
+        """Call `fn` once all records received so far are safely written"""
+        self._on_close.append(fn)
+
+    def close(self):
+        self.flush()
+        if self.path is not None:
+            self._close_current()
+        for fn in self._on_close:
+            fn()
+        self._on_close = []
+
+    def _open_next(self):
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        name = f"{self.prefix}-{stamp}-{os.getpid()}-{self.file_idx:05d}{self.suffix}"
+        self.path = self.output_dir / name
+        self.file_idx += 1
+        self.opened_at = time.time()
+        self._open(self.path.with_name(self.path.name + ".part"))
+
+    def _close_current(self):
+        self._close()
+        self.path.with_name(self.path.name + ".part").rename(self.path)
+        logger.info(f"Wrote {self.path}")
+        self.path = None
+        for fn in self._on_close:
+            fn()
+        self._on_close = []
+
+    def _expired(self) -> bool:
+        """Whether the current file, or the buffer if no file is open, is too old"""
+        if self.rotate_seconds is None:
+            return False
+        started = self.opened_at if self.path is not None else self.buffered_at
+        return time.time() - started >= self.rotate_seconds
+
+    def _accepts(self, records: List[Mapping[str, Any]]) -> bool:
+        """Whether `records` can be written to the current file"""
+        return True
+
+    def _open(self, path: Path):
+        raise NotImplementedError
+
+    def _write(self, records: List[Mapping[str, Any]]):
+        raise NotImplementedError
+
+    def _close(self):
+        raise NotImplementedError
+
+    def _size(self) -> int:
+        return self.path.with_name(self.path.name + ".part").stat().st_size
+
+
+class NdjsonFileSink(RotatingFileSink):
+    """Newline-delimited json files, optionally compressed with gzip or zstd"""
+
+    def __init__(self, output_dir, compression: str = "gzip", **kwargs):
+        super().__init__(output_dir, **kwargs)
+        if compression not in ("none", "gzip", "zstd"):
+            raise ValueError(f"Invalid compression: {compression}")
+        self.compression = compression
+        self.suffix = {"none": ".ndjson", "gzip": ".ndjson.gz", "zstd": ".ndjson.zst"}[
+            compression
+        ]
+
+    def checkpoint(self, fn: Callable):
+        # Each batch is flushed through the compressor, so records are safe after a flush
+        self._on_flush.append(fn)
+
+    def _open(self, path):
+        self.raw = path.open("wb")
+        if self.compression == "gzip":
+            import gzip
+
+            self.stream = gzip.GzipFile(fileobj=self.raw, mode="wb", compresslevel=6)
+        elif self.compression == "zstd":
+            import zstandard
+
+            self.stream = zstandard.ZstdCompressor(level=3).stream_writer(
+                self.raw, closefd=False
+            )
+        else:
+            self.stream = self.raw
+
+    def _write(self, records):
+        data = "".join(json.dumps(d, default=str) + "\n" for d in records)
+        self.stream.write(data.encode())
+        self.stream.flush()
+
+    def _close(self):
+        if self.stream is not self.raw:
+            self.stream.close()
+        self.raw.close()
+
+    def _size(self):
+        return self.raw.tell()
+
+
+class ColumnarFileSink(RotatingFileSink):
+    """Parquet or Arrow IPC files that keep timestamps as native timestamp columns
+
+    The schema of a file is inferred from its first batch. A batch with new fields, or
+    with values for a field that was all null so far, starts a new file with the union
+    of both schemas, so no field is dropped. Missing fields are null.
+    """
+
+    def __init__(self, output_dir, format: str = "parquet", **kwargs):
+        super().__init__(output_dir, **kwargs)
+        if format not in ("parquet", "arrow"):
+            raise ValueError(f"Invalid format: {format}")
+        self.format = format
+        self.suffix = {"parquet": ".parquet", "arrow": ".arrow"}[format]
+        self.schema = None
+
+    def _batch_schema(self, records):
+        import pyarrow as pa
+
+        inferred = pa.Table.from_pylist(records).schema
+        if self.schema is None:
+            return inferred
+        return pa.unify_schemas([self.schema, inferred])
+
+    def _accepts(self, records):
+        return self.writer is None or self._batch_schema(records).equals(self.schema)
+
+    def _open(self, path):
+        self.part_path = path
+        self.writer = None
+
+    def _write(self, records):
+        import pyarrow as pa
+
+        if self.writer is None:
+            self.schema = self._batch_schema(records)
+            if self.format == "parquet":
+                import pyarrow.parquet as pq
+
+                self.writer = pq.ParquetWriter(
+                    self.part_path, self.schema, compression="zstd"
+                )
+            else:
+                self.writer = pa.ipc.new_file(str(self.part_path), self.schema)
+        self.writer.write_table(pa.Table.from_pylist(records, schema=self.schema))
+
+    def _close(self):
+        if self.writer is not None:
+            self.writer.close()
+
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+import argparse
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Mapping, Optional, Sequence
+
+from loguru import logger
+
+from .mongo import setup_mongo
+
+KEYS = ("predicate", "expansion", "engine", "day")
+
+
+class ScrapeStats(object):
+    """Summary counters per (predicate, expansion, engine, day) in `webly.stats`
+
+    Writers increment the counters of a query once it is scraped, so that readers never
+    have to scan `webly.metadata`.
+    """
+
+    def __init__(self, db):
+        self.collection = db["stats"]
+
+    def record(
+        self,
+        d: Mapping[str, Any],
+        engine: str,
+        results: int,
+        extra: Optional[Mapping[str, int]] = None,
+    ):
+        now = datetime.utcnow()
+        key = {
+            "predicate": d.get("predicate"),
+            "expansion": d.get("expansion"),
+            "engine": engine,
+            "day": now.strftime("%Y-%m-%d"),
+        }
+        self.collection.update_one(
+            {"_id": key},
+            {
+                "$inc": {"queries": 1, "results": results, **(extra or {})},
+                "$max": {"last_utc": now},
+            },
+            upsert=True,
+        )
+
+    def counts(self, by: Sequence[str] = KEYS, query: Mapping = None) -> List[Dict]:
+        """Sum of the counters grouped by some of the keys, e.g. by engine"""
+        filter = {f"_id.{k}": v for k, v in (query or {}).items()}
+        totals = defaultdict(lambda: defaultdict(int))
+        for doc in self.collection.find(filter):
+            group = tuple(doc["_id"].get(k) for k in by)
+            for k, v in doc.items():
+                if isinstance(v, int):
+                    totals[group][k] += v
+        return [
+            {**dict(zip(by, group)), **counters}
+            for group, counters in sorted(totals.items(), key=lambda t: str(t[0]))
+        ]
+
+    def rebuild(self, metadata):
+        """Recompute the counters of existing documents, e.g. of runs before `webly.stats`"""
+        metadata.aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": {
+                            "predicate": "$predicate",
+                            "expansion": "$expansion",
+                            "engine": "$engine",
+                            "day": {
+                                "$dateToString": {
+                                    "format": "%Y-%m-%d",
+                                    "date": "$datetime_utc",
+                                }
+                            },
+                            "query": "$query",
+                        },
+                        "results": {"$sum": 1},
+                        "last_utc": {"$max": "$datetime_utc"},
+                    }
+                },
+                {
+                    "$group": {
+                        "_id": {
+                            "predicate": "$_id.predicate",
+                            "expansion": "$_id.expansion",
+                            "engine": "$_id.engine",
+                            "day": "$_id.day",
+                        },
+                        "queries": {"$sum": 1},
+                        "results": {"$sum": "$results"},
+                        "last_utc": {"$max": "$last_utc"},
+                    }
+                },
+                {"$out": self.collection.name},
+            ],
+            allowDiskUse=True,
+        )
+        logger.info(f"Rebuilt {self.collection.count_documents({})} counters")
+
+
+def find_duplicates(metadata) -> List[Dict]:
+    """Groups of documents with the same (predicate, query, engine, result_index)"""
+    cursor = metadata.aggregate(
+        [
+            {
+                "$group": {
+                    "_id": {
+                        "predicate": "$predicate",
+                        "query": "$query",
+                        "engine": "$engine",
+                        "result_index": "$result_index",
+                    },
+                    "count": {"$sum": 1},
+                    "unique_ids": {"$addToSet": "$_id"},
+                }
+            },
+            {"$match": {"count": {"$gt": 1}}},
+        ],
+        allowDiskUse=True,
+    )
+    return list(cursor)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Scraping statistics")
+    parser.add_argument(
+        "--mongo-url", type=str, help="url for database connections", required=True
+    )
+    parser.add_argument(
+        "--mongo-pass-file",
+        type=str,
+        help="password file for database connections",
+        default=None,
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    counts = commands.add_parser("counts", help="print counters from the summary")
+    counts.add_argument(
+        "--by",
+        choices=KEYS,
+        nargs="+",
+        help="group counters by these keys",
+        default=["predicate", "engine"],
+    )
+    for k in KEYS:
+        counts.add_argument(f"--{k}", type=str, help=f"only this {k}", default=None)
+
+    commands.add_parser("rebuild", help="recompute the summary from all documents")
+
+    dedupe = commands.add_parser(
+        "dedupe", help="find documents with the same predicate, query, engine and index"
+    )
+    dedupe.add_argument("--delete", action="store_true", help="keep only one of each")
+
+    return parser.parse_args()
+
+
+def main():
+    import tabulate
+
+    args = parse_args()
+    metadata = setup_mongo(args.mongo_url, args.mongo_pass_file)
+    stats = ScrapeStats(metadata.database)
+
+    if args.command == "counts":
+        query = {k: getattr(args, k) for k in KEYS if getattr(args, k) is not None}
+        print(tabulate.tabulate(stats.counts(args.by, query), headers="keys"))
+    elif args.command == "rebuild":
+        stats.rebuild(metadata)
+    elif args.command == "dedupe":
+        duplicates = find_duplicates(metadata)
+        print(
+            tabulate.tabulate(
+                [{**d["_id"], "count": d["count"]} for d in duplicates],
+                headers="keys",
+            )
+        )
+        if args.delete:
+            for d in duplicates:
+                metadata.delete_many({"_id": {"$in": d["unique_ids"][1:]}})
+            logger.info(f"Deleted duplicates of {len(duplicates)} documents")
+
+
+"""
+python -m webly.stats \
+    --mongo-url mongodb://user@localhost \
+    --mongo-pass-file .secrets/mongo_initdb_root_password \
+    counts --by engine day
+"""
+if __name__ == "__main__":
+    main()
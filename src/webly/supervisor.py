@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import os
+import signal
+import time
+from typing import List, Optional
+
+from loguru import logger
+
+from .journal import split_ranges
+from .scraper import chrome_helper, driver_helper, run, startup_ip_info
+
+MAX_BACKOFF = 300
+
+
+def worker_main(args, index: int, ip_info, stop, counters):
+    """Entry point of a worker process, SIGTERM stops it after the current query"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    logger.info(f"Worker {index} started (pid {os.getpid()})")
+
+    def progress(records: int):
+        with counters.get_lock():
+            counters[2 * index] += records
+            counters[2 * index + 1] += 1
+
+    run(args, driver_helper(args, ip_info), stop, progress)
+    logger.info(f"Worker {index} finished")
+
+
+class WorkerSlot(object):
+    def __init__(self, index: int, args: argparse.Namespace):
+        self.index = index
+        self.args = args
+        self.process: Optional[multiprocessing.Process] = None
+        self.started_at = 0.0
+        self.restart_at = 0.0
+        self.crashes = 0
+        self.done = False
+
+
+def supervise(args):
+    """Run `args.workers` scraper processes with one shared configuration
+
+    With amqp input all workers consume the same queue. With text or json input from
+    `--input-file`, each worker reads its own byte range of the file and records its
+    progress in the shared `--journal`, `<input-file>.journal` by default. Crashed
+    workers, and amqp workers that exit by themselves, are restarted with exponential
+    backoff. On SIGTERM or SIGINT workers finish their current query and stop, workers
+    that are still running after `--drain-timeout` seconds are killed; their unacked
+    messages are requeued by the broker.
+    """
+    slots: List[WorkerSlot] = []
+    for i in range(args.workers):
+        worker_args = argparse.Namespace(**vars(args))
+        worker_args.workers = None
+        slots.append(WorkerSlot(i, worker_args))
+
+    if args.input in ("text", "json"):
+        if args.input_file is None or args.input_range is not None:
+            raise ValueError(
+                f"--workers with --input {args.input} requires --input-file"
+            )
+        # Without a journal a restarted worker would scrape its range from the start
+        if args.journal is None:
+            args.journal = f"{args.input_file}.journal"
+            logger.info(f"Recording finished queries in {args.journal}")
+        for slot, input_range in zip(
+            slots, split_ranges(args.input_file, args.workers)
+        ):
+            slot.args.input_range = input_range
+            slot.args.journal = args.journal
+
+    # Check the IP once instead of in every worker, proxies are checked by the workers
+    ip_info = None
+    if args.proxies is None and args.proxy_file is None:
+        ip_info = startup_ip_info(
+            chrome_helper(
+                args.chrome_url,
+                args.chrome_token_file,
+                args.chrome_binary,
+                args.chrome_driver,
+            )
+        )
+
+    stop = multiprocessing.Event()
+    counters = multiprocessing.Array("q", 2 * args.workers)
+
+    def request_stop(signum, frame):
+        if not stop.is_set():
+            logger.info(f"Received {signal.Signals(signum).name}: draining workers")
+            stop.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    stop_at = None
+    start = last_report = time.time()
+    last_totals = (0, 0)
+    while True:
+        now = time.time()
+
+        for slot in slots:
+            p = slot.process
+            if p is not None and not p.is_alive():
+                p.join()
+                slot.process = None
+                # Queues never run out, an amqp worker only returns by itself when it
+                # stopped receiving, e.g. on a connection error or a consumer cancel
+                if stop.is_set() or (p.exitcode == 0 and args.input != "amqp"):
+                    slot.done = True
+                    continue
+                # A worker that ran for a while before crashing starts again from the base backoff
+                if now - slot.started_at > 10 * args.restart_backoff:
+                    slot.crashes = 0
+                slot.crashes += 1
+                backoff = min(
+                    MAX_BACKOFF, args.restart_backoff * 2 ** (slot.crashes - 1)
+                )
+                slot.restart_at = now + backoff
+                logger.warning(
+                    f"Worker {slot.index} exited with {p.exitcode}, restarting in {backoff:.0f}s"
+                )
+
+            if (
+                slot.process is None
+                and not slot.done
+                and not stop.is_set()
+                and now >= slot.restart_at
+            ):
+                slot.process = multiprocessing.Process(
+                    target=worker_main,
+                    args=(slot.args, slot.index, ip_info, stop, counters),
+                    name=f"scraper-{slot.index}",
+                )
+                slot.process.start()
+                slot.started_at = now
+
+        if stop.is_set():
+            if stop_at is None:
+                stop_at = now
+                for slot in slots:
+                    if slot.process is not None:
+                        slot.process.terminate()
+            elif now - stop_at > args.drain_timeout:
+                for slot in slots:
+                    if slot.process is not None and slot.process.is_alive():
+                        logger.warning(f"Worker {slot.index} did not drain, killing it")
+                        slot.process.kill()
+
+        alive = [s for s in slots if s.process is not None]
+        if len(alive) == 0 and (stop.is_set() or all(s.done for s in slots)):
+            break
+
+        if now - last_report >= args.stats_interval:
+            last_totals = log_throughput(
+                counters, now - last_report, last_totals, alive
+            )
+            last_report = now
+
+        time.sleep(1)
+
+    log_throughput(counters, time.time() - start, (0, 0), [])
+    logger.info("All workers stopped")
+
+
+def log_throughput(counters, seconds: float, last_totals, alive) -> tuple:
+    with counters.get_lock():
+        values = list(counters)
+    records, queries = sum(values[0::2]), sum(values[1::2])
+    logger.info(
+        f"Workers alive: {len(alive)}, "
+        f"records: {records} ({(records - last_totals[0]) / seconds:.2f}/s), "
+        f"queries: {queries} ({(queries - last_totals[1]) / seconds:.3f}/s), "
+        f"per worker: {values[0::2]}"
+    )
+    return records, queries
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Sequence, Union
+
+from loguru import logger
+
+
+class Tracer(object):
+    """Append one JSON line per timed span to a trace file, shared by all drivers"""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = self.path.open("a", buffering=1)
+        self._lock = threading.Lock()
+        logger.info(f"Tracing WebDriver commands to {self.path}")
+
+    @contextmanager
+    def span(self, command: str, tags: Dict[str, Any]):
+        start = time.time()
+        t0 = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.write(
+                {
+                    **tags,
+                    "command": command,
+                    "start": start,
+                    "duration": time.perf_counter() - t0,
+                    "error": error,
+                }
+            )
+
+    def write(self, span: Dict[str, Any]):
+        line = json.dumps(span)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class TracingProxy(object):
+    """Forward every attribute to `target`, timing method calls and properties like `.text`"""
+
+    def __init__(self, target, tracer: Tracer, tags: Dict[str, Any]):
+        self._target = target
+        self._tracer = tracer
+        self._tags = tags
+
+    def __getattr__(self, name):
+        if isinstance(getattr(type(self._target), name, None), property):
+            with self._tracer.span(name, self._tags):
+                return self._wrap(getattr(self._target, name))
+
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value
+
+        def traced(*args, **kwargs):
+            args = [_unwrap(a) for a in args]
+            kwargs = {k: _unwrap(v) for k, v in kwargs.items()}
+            with self._tracer.span(name, self._tags):
+                result = value(*args, **kwargs)
+            return self._wrap(result)
+
+        return traced
+
+    def _wrap(self, value):
+        from selenium.webdriver.remote.webelement import WebElement
+
+        if isinstance(value, WebElement):
+            return TracingProxy(value, self._tracer, self._tags)
+        if isinstance(value, list) and any(isinstance(v, WebElement) for v in value):
+            return [self._wrap(v) for v in value]
+        return value
+
+
+class TracingDriver(TracingProxy):
+    """WebDriver wrapper that records a span for every command, see `set_tags`"""
+
+    def __init__(self, driver, tracer: Tracer):
+        super().__init__(driver, tracer, {})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        with self._tracer.span("quit", self._tags):
+            self._target.quit()
+
+
+def _unwrap(value):
+    if isinstance(value, TracingProxy):
+        return value._target
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unwrap(v) for v in value)
+    return value
+
+
+def set_tags(driver, **tags):
+    """Tag the following spans of a traced driver, e.g. with engine and query, no-op otherwise"""
+    if isinstance(driver, TracingDriver):
+        driver._tags.update(tags)
+
+
+def sleep(driver, seconds: float):
+    """Sleep and, if the driver is traced, record it as a `sleep` span"""
+    if isinstance(driver, TracingDriver):
+        with driver._tracer.span("sleep", driver._tags):
+            time.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+
+def percentile(sorted_values: Sequence[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted sequence"""
+    if len(sorted_values) == 0:
+        return float("nan")
+    # q * n / 100 instead of q / 100 * n, e.g. 7 / 100 * 100 rounds up to 8
+    idx = math.ceil(q * len(sorted_values) / 100) - 1
+    idx = max(0, min(len(sorted_values) - 1, idx))
+    return sorted_values[idx]
+
+
+def read_trace(path: Union[str, Path]) -> Iterable[Dict[str, Any]]:
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def summarize(spans: Iterable[Dict[str, Any]], by: Sequence[str] = ()) -> List[Dict]:
+    """Aggregate spans into per-command totals and latency percentiles, sorted by total time"""
+    durations = defaultdict(list)
+    errors = defaultdict(int)
+    for span in spans:
+        key = (*(span.get(k) for k in by), span["command"])
+        durations[key].append(span["duration"])
+        errors[key] += span.get("error") is not None
+
+    grand_total = sum(sum(d) for d in durations.values()) or 1.0
+    rows = []
+    for key, values in durations.items():
+        values.sort()
+        total = sum(values)
+        rows.append(
+            {
+                **dict(zip((*by, "command"), key)),
+                "count": len(values),
+                "errors": errors[key],
+                "total_s": total,
+                "share_%": 100 * total / grand_total,
+                "mean_ms": 1000 * total / len(values),
+                "p50_ms": 1000 * percentile(values, 50),
+                "p90_ms": 1000 * percentile(values, 90),
+                "p99_ms": 1000 * percentile(values, 99),
+                "max_ms": 1000 * values[-1],
+            }
+        )
+    rows.sort(key=lambda r: r["total_s"], reverse=True)
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="WebDriver trace summary")
+    parser.add_argument("trace_files", nargs="+", type=Path)
+    parser.add_argument(
+        "--by",
+        choices=["engine", "query", "result_index"],
+        nargs="+",
+        help="group by these tags in addition to the command, e.g. engine",
+        default=[],
+    )
+    return parser.parse_args()
+
+
+def main():
+    import tabulate
+
+    args = parse_args()
+    spans = (span for path in args.trace_files for span in read_trace(path))
+    rows = summarize(spans, by=args.by)
+    print(tabulate.tabulate(rows, headers="keys", floatfmt=".1f"))
+
+
+"""
+python -m webly.scraper \
+    --engines google yahoo flickr \
+    --chrome-url http://localhost:3000/webdriver \
+    --chrome-token-file .secrets/chrome_token \
+    --trace-file traces/scraper.jsonl \
+    --input text \
+    --output text
+
+python -m webly.tracing --by engine traces/scraper.jsonl
+"""
+if __name__ == "__main__":
+    main()
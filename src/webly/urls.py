@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import hashlib
+import re
+import threading
+import urllib.parse
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Mapping, Optional
+
+from loguru import logger
+
+from .blobs import BLOB_PREFIX, parse_data_url
+
+# Fields of a result reference that identify where it was scraped
+SCRAPE_REF = ("engine", "query", "result_index")
+
+# Query parameters that only track where a click came from
+TRACKING_PARAMS = re.compile(
+    r"^(utm_\w+|fbclid|gclid|dclid|msclkid|yclid|igshid|mc_cid|mc_eid|_ga|_gl|ref|ref_src)$",
+    re.IGNORECASE,
+)
+
+# Flickr photo urls are `<server>/<id>_<secret>[_<size>].<ext>` on any static host,
+# the size suffix only selects a rendition of the same photo
+FLICKR_HOST = re.compile(r"^(farm\d+|c\d+|live)\.static\.?flickr\.com$")
+FLICKR_PATH = re.compile(r"^/(\d+)/(\d+)_([0-9a-f]+)(?:_[0-9a-z]{1,2})?\.(\w+)$")
+
+
+def canonicalize_url(url: str) -> str:
+    """Canonical form of a result url, so that copies of one image compare equal
+
+    Inline `data:` urls map to the `blob:sha256:` url of their bytes. Urls that cannot
+    be parsed, e.g. with an invalid port or invalid base64, are kept as they are.
+    """
+    try:
+        return _canonicalize_url(url)
+    except ValueError as e:
+        logger.debug(f"Not canonicalized, {e}: {url[:100]}")
+        return url
+
+
+def _canonicalize_url(url: str) -> str:
+    if url.startswith(BLOB_PREFIX):
+        return url
+    if url.startswith("data:"):
+        _, data = parse_data_url(url)
+        return BLOB_PREFIX + hashlib.sha256(data).hexdigest()
+
+    parts = urllib.parse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    if scheme not in ("http", "https"):
+        return url
+    host = (parts.hostname or "").rstrip(".")
+    if ":" in host:
+        host = f"[{host}]"
+    if parts.port is not None and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    path = parts.path or "/"
+    query = sorted(
+        (k, v)
+        for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+        if not TRACKING_PARAMS.match(k)
+    )
+
+    if FLICKR_HOST.match(host):
+        match = FLICKR_PATH.match(path)
+        if match is not None:
+            server, photo, secret, ext = match.groups()
+            host = "live.staticflickr.com"
+            path = f"/{server}/{photo}_{secret}.{ext}"
+
+    return urllib.parse.urlunsplit(
+        ("https", host, path, urllib.parse.urlencode(query), "")
+    )
+
+
+class MemorySeenUrls(object):
+    """Canonical urls seen by this process"""
+
+    def __init__(self):
+        self.seen: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+
+    def first_seen(self, canonical_url: str, ref: Dict) -> Optional[Dict]:
+        """Reference of the first result with this url, None if `ref` is the first"""
+        with self.lock:
+            first = self.seen.get(canonical_url)
+            if first is None:
+                self.seen[canonical_url] = ref
+            return first
+
+
+class MongoSeenUrls(object):
+    """Canonical urls seen by all scrapers, in `webly.urls`"""
+
+    def __init__(self, db):
+        self.collection = db["urls"]
+
+    def first_seen(self, canonical_url: str, ref: Dict) -> Optional[Dict]:
+        from pymongo import ReturnDocument
+
+        doc = self.collection.find_one_and_update(
+            {"_id": canonical_url},
+            {
+                "$setOnInsert": {"first": ref},
+                "$inc": {"count": 1},
+                "$max": {"last_utc": datetime.utcnow()},
+            },
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
+        )
+        return doc["first"] if doc is not None else None
+
+
+def mark_duplicate(record: Mapping[str, Any], seen) -> Dict[str, Any]:
+    """Add the canonical url, and reduce repeats of a seen url to a reference
+
+    The reference keeps the query, caption and IP of the repeat, but no url to download:
+    its image is the one of the first result with the same `canonical_url`, whose `_id`
+    and origin are in `duplicate_of`. Records get an `_id` here, the downloader names
+    images after it. A re-scrape of the first result itself is not a duplicate.
+    """
+    canonical_url = canonicalize_url(record["url"])
+    record = {**record, "_id": record.get("_id") or uuid.uuid4().hex}
+    ref = {"_id": record["_id"], **{k: record.get(k) for k in SCRAPE_REF}}
+    first = seen.first_seen(canonical_url, ref)
+    if first is None or all(first.get(k) == ref[k] for k in SCRAPE_REF):
+        return {**record, "canonical_url": canonical_url, "duplicate": False}
+    logger.trace(f"Duplicate of {first}: {canonical_url}")
+    return {
+        **{k: v for k, v in record.items() if k not in ("url", "blob")},
+        "canonical_url": canonical_url,
+        "duplicate": True,
+        "duplicate_of": first,
+    }